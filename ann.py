@@ -0,0 +1,141 @@
+# ------------------------------------------------------------------------------------
+# approximate nearest neighbours: kNN graph of all images over the reduced vectors,
+# exact for up to ANNEXACT images, else from the IVF index (inverted lists of the
+# coarse k-means, images of a list are searched in the ANNPROBE lists nearest to it);
+# the graph is saved into the cache dir with paths of its rows, and reused while the
+# set of images doesn't change; it serves the -dup report and the knn clustering
+
+ANNK = 16 # neighbours per image
+ANNEXACT = 20000 # max. images for the exact search
+ANNPROBE = 8 # lists searched per list
+ANNGRAPH = None # the kNN graph (nn,nd) of the current vectors
+
+# file of the saved graph
+def ann_file(): return f"{args.storedir}/{cache.sx2}.ann.npz"
+
+# load the saved graph, with rows permuted to the current paths (None if not usable)
+def ann_load():
+  file = ann_file()
+  if not os.path.exists(file): return None
+  saved = np.load(file)
+  if len(saved["paths"]) != len(paths) or saved["nn"].shape[1] != min(ANNK,len(paths)-1): return None
+  row = {p:i for i,p in enumerate(saved["paths"])}
+  if any(not p in row for p in paths): return None
+  perm = np.array([row[p] for p in paths])	# saved row of current rows
+  inv = np.empty(len(perm),dtype=np.int64)	# current row of saved rows
+  inv[perm] = np.arange(len(perm))
+  return inv[saved["nn"][perm]],saved["nd"][perm]
+
+# save the graph with paths of rows
+def ann_save(nn,nd):
+  if not args.cache: return
+  if not os.path.isdir(args.storedir): os.makedirs(args.storedir)
+  with open(ann_file(),"wb") as fd: np.savez(fd,nn=nn,nd=nd.astype(np.float32),paths=np.array(paths))
+
+# kNN graph from the IVF index
+def ann_ivf(X,k):
+  n = len(X)
+  nlist = int(4*np.sqrt(n))
+  ivf = mkm_engine(nlist,1,random_state=args.seed).fit(X)
+  lists = np.argsort(ivf.labels_,kind="stable")
+  starts = np.concatenate(([0],np.cumsum(np.bincount(ivf.labels_,minlength=nlist))))
+  probe,_ = tsp_knn(ivf.cluster_centers_,min(ANNPROBE,nlist-1))
+  nn = np.empty((n,k),dtype=np.int64)
+  nd = np.empty((n,k),dtype=np.float32)
+  for l in range(nlist):
+    q = lists[starts[l]:starts[l+1]]
+    if not len(q): continue
+    c = np.concatenate([lists[starts[j]:starts[j+1]] for j in [l,*probe[l]]])
+    Q = np.asarray(X[q],dtype=np.float32)
+    C = np.asarray(X[c],dtype=np.float32)
+    d = mkm_dist(Q,C,np.einsum("ij,ij->i",C,C))
+    d[c[None,:] == q[:,None]] = np.inf	# not itself
+    kk = min(k,len(c)-1)
+    j = np.argpartition(d,kk-1,axis=1)[:,:kk]
+    dj = np.take_along_axis(d,j,1)
+    o = np.argsort(dj,1)
+    nn[q] = q[:,None]; nd[q] = np.inf	# lists with less than k candidates
+    nn[q,:kk] = c[np.take_along_axis(j,o,1)]
+    nd[q,:kk] = np.sqrt(np.take_along_axis(dj,o,1))
+  return nn,nd
+
+# compute the kNN graph of X
+def ann_knn(X):
+  k = min(ANNK,len(X)-1)
+  if len(X) <= ANNEXACT: nn,nd = tsp_knn(np.asarray(X,dtype=np.float32),k)
+  else:                  nn,nd = ann_ivf(X,k)
+  return nn,nd.astype(np.float32)
+
+# the kNN graph of all vectors: from the cache, or computed (and saved), the graph
+# of other vectors (like a sample in the sweep) is just computed
+def ann_graph(X):
+  global ANNGRAPH
+  if len(X) != len(paths): return ann_knn(X)
+  if ANNGRAPH is not None: return ANNGRAPH
+  MSG1("knn graph"); T1 = vtime()
+  ANNGRAPH = ann_load()
+  if ANNGRAPH is not None: MSG2(f"loaded from {ann_file()},")
+  else:
+    ANNGRAPH = ann_knn(X)
+    MSG2("exact," if len(X) <= ANNEXACT else "ivf,")
+    ann_save(*ANNGRAPH)
+  MSG3(f"{len(X)} images, {ANNGRAPH[0].shape[1]} neighbours, in {minsec(vtime()-T1)}")
+  return ANNGRAPH
+
+# ------------------------------------------------------------------------------------
+
+# near-duplicates report: groups of images connected by kNN edges shorter than thr
+def ann_dup(X,thr,output):
+  nn,nd = ann_graph(X)
+  csgraph = timport("scipy.sparse.csgraph")
+  sparse = timport("scipy.sparse")
+  rows,cols = np.nonzero(nd < thr)
+  G = sparse.coo_matrix((np.ones(len(rows)),(rows,nn[rows,cols])),shape=(len(X),len(X)))
+  _,group = csgraph.connected_components(G,directed=True,connection="weak")
+  size = np.bincount(group)
+  dup = np.flatnonzero(size[group] > 1)
+  dup = dup[np.lexsort((nd[dup,0],group[dup]))]
+  ids = np.unique(group[dup],return_inverse=True)[1]	# groups renumbered from 1
+  with open(output,"w") as fd:
+    fd.write("#path group nndist\n")
+    fd.writelines(f"{paths[i]} {g+1} {nd[i,0]:.2f}\n" for i,g in zip(dup,ids))
+  MSG1("duplicates")
+  MSG2(f"{len(dup)} images in {np.count_nonzero(size>1)} groups below {thr}")
+  MSG3(f"(median nn dist {np.median(nd[:,0]):.2f}) in {output}")
+
+# knn clustering: Louvain communities of the kNN graph, with the resolution searched
+# to get close to the requested number of clusters
+def knn_fit(clust,X):
+  nn,nd = ann_graph(X)
+  nx = timport("networkx")
+  sigma = float(np.median(nd[:,-1])) or 1
+  G = nx.Graph()
+  G.add_nodes_from(range(len(X)))
+  ok = np.isfinite(nd)
+  rows,cols = np.nonzero(ok)
+  G.add_weighted_edges_from(zip(rows.tolist(),nn[rows,cols].tolist(),np.exp(-(nd[rows,cols]/sigma)**2).tolist()))
+
+  res,best = 1.0,None
+  for i in range(8):
+    comm = nx.community.louvain_communities(G,resolution=res,seed=clust.random_state)
+    if best is None or abs(len(comm)-clust.n_clusters) < abs(len(best)-clust.n_clusters): best = comm
+    if len(comm) == clust.n_clusters: break
+    res *= (clust.n_clusters/len(comm))**0.5
+  labels = np.empty(len(X),dtype=np.int32)
+  for j,c in enumerate(best): labels[list(c)] = j
+
+  # centers are the means of communities
+  k = len(best)
+  sums = np.zeros((k,X.shape[1]),dtype=np.float64)
+  for i in range(0,len(X),BATCHSIZE): np.add.at(sums,labels[i:i+BATCHSIZE],X[i:i+BATCHSIZE])
+  clust.cluster_centers_ = (sums/np.bincount(labels,minlength=k)[:,None]).astype(np.float32)
+  clust.labels_ = labels
+  clust.inertia_ = sum(float(((X[i:i+BATCHSIZE]-clust.cluster_centers_[labels[i:i+BATCHSIZE]])**2).sum()) for i in range(0,len(X),BATCHSIZE))
+  return clust
+
+# the engine, with the sklearn-like interface used by imclust
+def knn_engine(k,random_state=None,verbose=0):
+  clust = types.SimpleNamespace(n_clusters=k,random_state=random_state,verbose=verbose)
+  clust.fit = lambda X: knn_fit(clust,X)
+  return clust
+
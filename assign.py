@@ -0,0 +1,111 @@
+import pickle
+
+# ------------------------------------------------------------------------------------
+# incremental mode: the fitted clustering (centers, reference to the stored reducer,
+# thresholds, order of clusters) is saved next to the output csv as .model, the reducer
+# itself only when it is not stored along the cache; with -ad the new images (not in
+# that csv yet) are perceived and assigned to the nearest centers and the csv is
+# updated, unless the drift of distances from the centers is over the -dr threshold,
+# then all images are clustered again
+
+AMODEL = None # loaded model of the clustering to assign new images to
+
+# model file of the output csv
+def model_file(output): return re.sub("\.csv$","",output) + ".model"
+
+# save the model of the clustering (for csv output only)
+def model_save(output,meandist):
+  if args.html: return
+  file = redim_file(cache) if args.cache and cache.rdigest and os.path.exists(redim_file(cache)) else None
+  model = {"output":output,"clust":CLUST,"clusters":CLUSTERS,"centers":clust.cluster_centers_,
+    "cindex":list(cindex),"redim":REDIM,"redimsize":REDIMSIZE,"sx2":cache.sx2,"rdigest":cache.rdigest,
+    "reducer":None if file else redim.model,"redimfile":os.path.abspath(file) if file else None,
+    "maxdist":float(maxdist),"d0":d0,"distthr":args.distthr,"percthr":args.percthr,
+    "meandist":meandist,"images":IMAGES}
+  with open(model_file(output),"wb") as fd: pickle.dump(model,fd)
+
+# load the model and take over the clustering setup from it
+def assign_init(file):
+  global AMODEL,CLUST,REDIM,REDIMSIZE
+  if not os.path.exists(file): MSGE(f"no model {file}")
+  with open(file,"rb") as fd: AMODEL = pickle.load(fd)
+  CLUST,REDIM,REDIMSIZE = AMODEL["clust"],AMODEL["redim"],AMODEL["redimsize"]
+  if not args.clusters: args.clusters = AMODEL["clusters"]
+  if args.distthr is None: args.distthr = AMODEL["distthr"]
+  if args.percthr is None: args.percthr = AMODEL["percthr"]
+  if not os.path.exists(AMODEL["output"]): MSGE(f"no {AMODEL['output']} to add images to")
+  MSG("model",f"{CLUST}{AMODEL['clusters']} of {AMODEL['images']} images from {file}")
+
+# paths of images already in the output csv
+def assign_known():
+  with open(AMODEL["output"]) as fd:
+    return [line.split(" ",1)[0] for line in fd if line[0] != "#"]
+
+# return new paths only (exit if there are none)
+def assign_filter(paths):
+  known = set(assign_known())
+  new = [p for p in paths if not p in known]
+  MSG("new images",f"{len(new)} (of {len(paths)})")
+  if not new: exit(0)
+  return new
+
+# assign new images to the nearest centers, return the drift in percents: how much
+# their mean distance from the centers exceeds that of the clustered images
+def assign(vectors,paths):
+  MSG1("assign"); T1 = vtime()
+  if cache.sx2 != AMODEL["sx2"]: MSGE(f"vectors {cache.sx2} differ from the model {AMODEL['sx2']}")
+  centers = AMODEL["centers"]
+  csq = np.einsum("ij,ij->i",centers,centers)
+  idx = np.empty(len(vectors),dtype=np.int64)
+  dist = np.empty(len(vectors),dtype=np.float32)
+  for i in range(0,len(vectors),BATCHSIZE):
+    v = np.asarray(vectors[i:i+BATCHSIZE])
+    d = np.einsum("ij,ij->i",v,v)[:,None] + csq[None,:] - 2*v@centers.T
+    idx[i:i+BATCHSIZE] = np.argmin(d,1)
+    dist[i:i+BATCHSIZE] = np.sqrt(np.maximum(d[np.arange(len(d)),idx[i:i+BATCHSIZE]],0))
+  drift = (dist.mean()/AMODEL["meandist"]-1)*100 if AMODEL["meandist"] else 0
+  MSG2(f"{len(vectors)} images to {len(centers)} clusters,")
+  MSG3(f"drift {drift:.1f}% in {minsec(vtime()-T1)}")
+  if args.drift is not None and drift > args.drift:
+    MSG("refit",f"drift over {args.drift}%, all images will be clustered again")
+    return None
+  assign_write(paths,idx,dist)
+  return drift
+
+# add new images into the csv: to the end of accepted images of their cluster, or to
+# the end of the cluster if beyond thresholds, the csv is rewritten atomically
+def assign_write(paths,idx,dist):
+  M = AMODEL
+  pos = np.empty(len(M["cindex"]),dtype=np.int64)	# cluster -> its output number
+  pos[M["cindex"]] = np.arange(len(M["cindex"]))
+  with np.errstate(divide="ignore",invalid="ignore"):
+    pdist = (M["maxdist"]-dist)/(M["maxdist"]-M["d0"][idx])*100
+  pdist[~np.isfinite(pdist)] = 100
+  bad = np.zeros(len(paths),dtype=bool)
+  if args.distthr: bad |= dist > args.distthr
+  if args.percthr: bad |= pdist < args.percthr
+
+  # csv lines per output cluster: accepted, and beyond thresholds, old then new
+  K = len(M["cindex"])
+  groups = [([],[]) for j in range(K+1)]
+  output = M["output"]
+  with open(output) as fd:
+    head = fd.readline()
+    for line in fd:
+      f = line.split(" ")
+      groups[int(f[1])][f[4][0] == "1"].append(line)
+  for i in np.lexsort((dist,pos[idx])):
+    j = pos[idx[i]]+1
+    groups[j][int(bad[i])].append(f"{paths[i]} {j} {dist[i]:.1f} {pdist[i]:.1f} {int(bad[i])}\n")
+
+  with open(f"{output}.tmp","w",buffering=1<<20) as fd:
+    fd.write(head)
+    for good,poor in groups:
+      fd.writelines(good)
+      fd.writelines(poor)
+  os.replace(f"{output}.tmp",output)
+
+  AMODEL["images"] += len(paths)
+  with open(model_file(output),"wb") as fd: pickle.dump(AMODEL,fd)
+  MSG("write output",f"{len(paths)} images added to {output}")
+
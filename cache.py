@@ -1,4 +1,6 @@
 import numpy as np
+# include "store.py"
+# include "ckeys.py"
 
 # ------------------------------------------------------------------------ cache paths
 
@@ -9,30 +11,149 @@ def cpath(base,sx,cdir):
     path = re.sub("^.*\/",f"{cdir}/",path)	# replace directory (if needed)
   return path
 
+# whether the suffix is of the cache files, not of the precomputed input files
+def iscached(cache,sx): return not sx in cache.inputs
+
+# return the key of the image in the cache: the content key, or absolute path
+def ckey(cache,path):
+  if cache.keys: return cache.keys[path]
+  return os.path.abspath(path)
+
+# return the path to cache file, named by the content key if available
+def ckpath(cache,base,sx):
+  if not iscached(cache,sx): return cpath(base,sx,cache.cdir)
+  sx = qsx(cache,sx)
+  if not cache.keys: return cpath(base,sx,cache.cdir)
+  dir = cache.cdir if cache.cdir!="" else os.path.dirname(base)
+  if dir == "": dir = "."
+  return f"{dir}/{cache.keys[base]}.{sx}"
+
 # ------------------------------------------------------------------------------------
+# encodings of cached vectors: f32, f16, or i8 (int8 vector with its float32 scale
+# ahead), the encoding is a part of the cache files suffix, inputs are always f32
+
+QDTYPES = {"f32":np.float32,"f16":np.float16,"i8":np.uint8} # file dtypes
+
+# encoding of the cache files of the suffix
+def qenc(cache,sx): return cache.quant if iscached(cache,sx) else "f32"
+
+# actual suffix of the cache files
+def qsx(cache,sx): return sx if qenc(cache,sx) == "f32" else f"{sx}-{cache.quant}"
+
+# encode batch of vectors into rows of the encoding
+def qencode(vectors,enc):
+  v = np.asarray(vectors,dtype=np.float32)
+  if enc == "f16": return v.astype(np.float16)
+  if enc == "i8":
+    scale = np.abs(v).max(1) / 127
+    scale[scale == 0] = 1
+    q = np.rint(v/scale[:,None]).astype(np.int8)
+    return np.concatenate((scale.astype(np.float32)[:,None].view(np.uint8),q.view(np.uint8)),axis=1)
+  return v
 
-# numpy save float32 raw array
-def saveraw(name,data):
-  arr = np.array(data,"float32")
+# decode batch of encoded rows into float32 vectors
+def qdecode(rows,enc):
+  if enc == "f16": return rows.astype(np.float32)
+  if enc == "i8":
+    rows = np.ascontiguousarray(rows)
+    return rows[:,4:].view(np.int8).astype(np.float32) * rows[:,:4].view(np.float32)
+  return rows
+
+# numpy save raw array (vector) in the encoding
+def saveraw(name,data,enc="f32"):
+  arr = qencode(np.reshape(data,(1,-1)),enc)
   file = open(name,"wb")
   arr.tofile(file)
   file.close()
 
 # numpy load float32 raw array, as a concatenation of vectors from multiple files
-def loadraw(base,sx,cdir):
-  return np.concatenate([np.fromfile(cpath(base,s,cdir),dtype="float32") for s in sx.split(",")])
+def loadraw(cache,base,sx):
+  return np.concatenate([np.fromfile(ckpath(cache,base,s),dtype="float32") for s in sx.split(",")])
 
-# load batch of raw files into vectors, size is size of every vector
-def loadraws(paths,sx,cdir):
-  return np.array([loadraw(p,sx,cdir) for p in paths])
+# load batch of raw files into vectors, size is size of every vector, encoded files
+# are decoded in batch
+def loadraws(cache,paths,sx):
+  enc = qenc(cache,sx)
+  if enc == "f32": return np.array([loadraw(cache,p,sx) for p in paths])
+  return qdecode(np.array([np.fromfile(ckpath(cache,p,sx),dtype=QDTYPES[enc]) for p in paths]),enc)
 
 # load batch of raw files into vectors, size is size of every vector
-def saveraws(paths,sx,cdir,vectors):
+def saveraws(cache,paths,sx,vectors):
+  rows = qencode(vectors,qenc(cache,sx))
   i = 0
   for path in paths:
-    saveraw(cpath(path,sx,cdir),vectors[i])
+    rows[i].tofile(ckpath(cache,path,sx))
     i += 1
 
+# ------------------------------------------------------------------------------------
+
+# sizes of files of images for the suffix (0 for missing), by the store index, or by
+# a single listing per cache dir (in parallel threads), not by the file per file checks
+def csizes(cache,paths,sx,sizes=0):
+  if sx in cache.stores: return [int(store_has(cache.stores[sx],ckey(cache,p))) for p in paths]
+  files = [ckpath(cache,p,sx) for p in paths]
+  pool = ThreadPool(THREADS)
+  ok = scan_exist(files,pool,sizes)
+  pool.close()
+  return [ok.get(f,0) for f in files]
+
+# load batch of vectors from the cache (store or per-image files)
+def cload(cache,paths,sx):
+  if sx in cache.stores: return store_get(cache.stores[sx],[ckey(cache,p) for p in paths])
+  return loadraws(cache,paths,sx)
+
+# save batch of vectors into the cache (store or per-image files)
+def csave(cache,paths,sx,vectors):
+  if sx in cache.stores: store_put(cache.stores[sx],[ckey(cache,p) for p in paths],vectors)
+  else: saveraws(cache,paths,sx,vectors)
+
+# ------------------------------------------------------------------------------------
+# quarantine of malformed images: "size mtime abspath" per line of the bad.lst file,
+# quarantined images are skipped in next runs, until the image file is changed
+
+def quarantine_file(): return f"{args.storedir}/bad.lst"
+
+# load the quarantine: abspath -> (size,mtime)
+def quarantine_load():
+  quar = {}
+  if not os.path.exists(quarantine_file()): return quar
+  with open(quarantine_file()) as fd:
+    for line in fd:
+      size,mtime,path = line.rstrip("\n").split(" ",2)
+      quar[path] = (int(size),int(mtime))
+  return quar
+
+# whether the image is in quarantine and unchanged since
+def quarantined(quar,path):
+  q = quar.get(os.path.abspath(path))
+  if not q: return 0
+  try: st = os.stat(path)
+  except OSError: return 1
+  return q == (st.st_size,st.st_mtime_ns)
+
+# no. of images of the list in quarantine
+def quarantine_count(paths):
+  quar = quarantine_load()
+  return sum(quarantined(quar,p) for p in paths) if quar else 0
+
+# drop malformed images from the lists of images to load, and quarantine them
+def cache_drop(cache,bad):
+  drop = set(bad)
+  cache.paths0    = [p for p in cache.paths0 if not p in drop]
+  cache.paths0all = [p for p in cache.paths0all if not p in drop]
+  cache.bad += bad
+  if not args.cache: return
+  if not os.path.isdir(args.storedir): os.makedirs(args.storedir)
+  with open(quarantine_file(),"a") as fd:
+    for p in bad:
+      try: st = os.stat(p); size,mtime = st.st_size,st.st_mtime_ns
+      except OSError: size,mtime = -1,-1
+      fd.write(f"{size} {mtime} {os.path.abspath(p)}\n")
+
+# MSG print of malformed images
+def MSGbad(bad):
+  if bad: MSG("malformed",f"{len(bad)} images dropped" + (f", quarantined in {quarantine_file()}" if args.cache else ""))
+
 # ------------------------------------------------------------------------------------
 # "cache" are three sets of files: cached, partially-cached, not-cached
 
@@ -50,49 +171,66 @@ def MSG2cached(cache):
   MSG3(f"{len(cache.paths0)} pictures")
 
 # scan cached files
-def caching_init(paths,model,cachedir,redim,redimsize):
+def caching_init(paths,model,cachedir,redim,redimsize,keys):
   if redim == "none": redimsize = ""
   cache = types.SimpleNamespace()
   cache.cdir	  = cachedir
   cache.sx1	  = f"{model}" # actual suffix for perception cached files
   cache.sx2	  = f"{model}-{redim}{redimsize}" # perception+redim
   cache.sx1s	  = cache.sx1
+  cache.quant	  = QUANT	# encoding of cache files
+  cache.stores	  = {}	# vector stores by suffix (when requested)
+  cache.keys	  = keys	# content keys of images (or None)
+  cache.inputs	  = set()	# suffixes of precomputed input files
   cache.paths0    = []	# paths to pictures (when no cache is available)
   cache.paths1    = []	# paths to model cache
   cache.paths2    = []	# paths to model + reducer
   cache.paths1all = []	# all available model-cached data
   cache.paths0all = []	# when no model cache is available
+  cache.bad	  = []	# malformed images, dropped
+  quar = quarantine_load()
+  redim_attach(cache,paths)
+
+  if args.store:
+    cache.stores[cache.sx1] = store_open(args.storedir,qsx(cache,cache.sx1),cache.quant)
+    if cache.rdigest: cache.stores[cache.sx2] = store_open(args.storedir,qsx(cache,cache.sx2),cache.quant)
 
   MSG1("cache files")
-  if redim == "none": MSG3(f"{cache.sx1} cache suffixes")
-  else: MSG3(f"{cache.sx1} and {cache.sx2} cache suffixes")
+  if redim == "none": MSG2(f"{qsx(cache,cache.sx1)} cache suffixes")
+  else: MSG2(f"{qsx(cache,cache.sx1)} and {qsx(cache,cache.sx2)} cache suffixes")
+  MSG3("(vector store)" if cache.stores else "")
 
   MSG1("cache status")
 
+  # empty files (of an interrupted write) are not cached, recomputed and overwritten
+  nquar = 0 # skipped quarantined images
   if redim == "none":
-    for p0 in paths:
-      p1 = cpath(p0,cache.sx1,cachedir)
-      if os.path.exists(p1):
+    for p0,c1 in zip(paths,csizes(cache,paths,cache.sx1,1)):
+      if c1:
         cache.paths1.append(p0)
         cache.paths1all.append(p0)
+      elif quarantined(quar,p0): nquar += 1
       else:
         cache.paths0.append(p0)
         cache.paths0all.append(p0)
   else:
-    for p0 in paths:
-      p1 = cpath(p0,cache.sx1,cachedir)
-      p2 = cpath(p0,cache.sx2,cachedir)
-      if   os.path.exists(p2):	cache.paths2.append(p0)
-      elif os.path.exists(p1):	cache.paths1.append(p0)
-      else:			cache.paths0.append(p0)
-      if os.path.exists(p1):	cache.paths1all.append(p0)
-      else:			cache.paths0all.append(p0)
+    c2s = csizes(cache,paths,cache.sx2,1) if cache.rdigest else [0]*len(paths) # reduced by the stored reducer only
+    for p0,c1,c2 in zip(paths,csizes(cache,paths,cache.sx1,1),c2s):
+      if not c1 and not c2 and quarantined(quar,p0):
+        nquar += 1
+        continue
+      if   c2:				cache.paths2.append(p0)
+      elif c1:				cache.paths1.append(p0)
+      else:				cache.paths0.append(p0)
+      if c1:				cache.paths1all.append(p0)
+      else:				cache.paths0all.append(p0)
 
+  if nquar: MSG2(f"{nquar} quarantined skipped,")
   MSG2cached(cache)
   return cache
 
 # input vectors from precomputed files by suffix
-def caching_init_prec(paths,sx1s,cachedir,redim,redimsize):
+def caching_init_prec(paths,sx1s,cachedir,redim,redimsize,keys):
   if redim == "none": redimsize = ""
   cache = types.SimpleNamespace()
   cache.cdir	  = cachedir
@@ -100,11 +238,16 @@ def caching_init_prec(paths,sx1s,cachedir,redim,redimsize):
   cache.sx1s	  = sx1s			# save orig string for loader
   cache.sx1	  = re.sub(",","",sx1s)		# actual (output) file suffix
   cache.sx2 = f"{cache.sx1}-{redim}{redimsize}"	# inputs+redim
+  cache.quant	  = QUANT	# encoding of cache files (not of inputs)
+  cache.stores	  = {}	# vector stores by suffix, only for reduced vectors
+  cache.keys	  = keys	# content keys of images (or None)
+  cache.inputs	  = set(sx1a+[sx1s])	# suffixes of precomputed input files
   cache.paths0    = []	# paths to pictures (when no cache is available)
   cache.paths1    = []	# paths to model cache
   cache.paths2    = []	# paths to model + reducer
   cache.paths1all = []	# all available model-cached data
   cache.paths0all = []	# when no model cache is available
+  cache.bad	  = []	# malformed images, dropped
   sizes = []		# list of sizes strings
   size = 0		# accumulated total size
 
@@ -112,16 +255,10 @@ def caching_init_prec(paths,sx1s,cachedir,redim,redimsize):
   MSG("cache files",f"{' '.join(sx1a)} cache suffixes")
   MSG1("cache status")
   
-  for p0 in paths:
-
-    # for EVERY suffix, the file must exist
-    allok = 1
-    for sx in sx1a:
-      p = cpath(p0,sx,cachedir)
-      # MSG(f"{p0} {sx}",f"{p}")
-      if not os.path.exists(p):   allok = 0	# file does not exist
-      if os.path.getsize(p) == 0: allok = 0	# file is empty
-    if not allok: continue
+  # for EVERY suffix, the file must exist and not be empty
+  bytes = [csizes(cache,paths,sx,1) for sx in sx1a]
+  for i,p0 in enumerate(paths):
+    if not all(b[i] for b in bytes): continue
 
     # remember the image path
     cache.paths1.append(p0)
@@ -129,15 +266,19 @@ def caching_init_prec(paths,sx1s,cachedir,redim,redimsize):
 
     # get the size from 1st files
     if not size:
-      for sx in sx1a:
-        p = cpath(p0,sx,cachedir)
-        sz = int(os.path.getsize(p)/4) # fro float 32
+      for b in bytes:
+        sz = b[i]//4 # for float 32
         size += sz
         sizes.append(str(sz))
 
+  if not cache.paths1: MSGE(f"no {sx1s} vectors found" + (f" in {cachedir}" if cachedir!="" else ""))
+
   # fix the suffix
-  if redim != "none" and vsize < redimsize:
-    cache.sx2 = f"{cache.sx1}-{redim}{vsize}"
+  if redim != "none" and size < redimsize:
+    cache.sx2 = f"{cache.sx1}-{redim}{size}"
+  redim_attach(cache,paths)
+  if args.store and cache.rdigest:
+    cache.stores[cache.sx2] = store_open(args.storedir,qsx(cache,cache.sx2),cache.quant)
 
   MSG2cached(cache)
   MSG1("vectors size")
@@ -0,0 +1,58 @@
+import hashlib
+from multiprocessing.pool import ThreadPool
+
+# ------------------------------------------------------------------------------------
+# content keys of images, to name the cache files independently of image paths:
+#   stat - fingerprint of absolute path, size and mtime (fast, distinct files never share it)
+#   hash - hash of the file bytes (slow, the same picture anywhere gets the same key)
+# keys are remembered in the index file by path, size and mtime, and recomputed
+# only when the file changed
+
+# compute the key of a single file, st is its os.stat
+def ckey_compute(path,st,mode):
+  if mode == "stat":
+    s = f"{os.path.abspath(path)} {st.st_size} {st.st_mtime_ns}".encode()
+  else:
+    with open(path,"rb") as fd: s = fd.read()
+  return hashlib.blake2b(s,digest_size=16).hexdigest()
+
+# return dict of image paths -> keys, using and updating the index in dir
+def ckeys_init(paths,mode,dir):
+  MSG1(f"{mode} keys"); T1 = vtime()
+  index = f"{dir}/keys-{mode}.idx"
+
+  # load the index: "size mtime key abspath" per line
+  known = {}
+  if os.path.exists(index):
+    with open(index) as fd:
+      for line in fd:
+        size,mtime,key,path = line.rstrip("\n").split(" ",3)
+        known[path] = (int(size),int(mtime),key)
+
+  # reuse indexed keys of unchanged files, compute the rest
+  def worker(path):
+    apath = os.path.abspath(path)
+    st = os.stat(path)
+    k = known.get(apath)
+    if k and k[0] == st.st_size and k[1] == st.st_mtime_ns: return apath,st,k[2],0
+    return apath,st,ckey_compute(path,st,mode),1
+  pool = ThreadPool(THREADS)
+  results = pool.map(worker,paths,chunksize=256)
+  pool.close()
+
+  keys = {}
+  new = []
+  for path,(apath,st,key,isnew) in zip(paths,results):
+    keys[path] = key
+    if isnew: new.append(f"{st.st_size} {st.st_mtime_ns} {key} {apath}\n")
+
+  # remember new keys
+  if new and args.cache:
+    if not os.path.isdir(dir): os.makedirs(dir)
+    with open(index,"a") as fd: fd.writelines(new)
+
+  MSG2(f"{len(paths)-len(new)} indexed, {len(new)} new,")
+  MSG2(f"{len(set(keys.values()))} unique")
+  MSG3(f"in {minsec(vtime()-T1)}")
+  return keys
+
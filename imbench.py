@@ -0,0 +1,298 @@
+#!/usr/bin/env -S python3 -u # -*- python -*-
+import os,sys,time,re,json,glob,shutil,platform,subprocess
+import numpy as np
+
+# default scales (no. of images), sizes and clustering engines of the benchmark
+SCALES = (10000,)
+IMAGES = 2000 # max. no. of synthetic pictures per scale (the rest is vectors only)
+VSIZE = 512 # size of synthetic precomputed vectors
+ISIZE = 64 # width and height of synthetic pictures
+GROUPS = 64 # no. of gaussian groups in the synthetic data
+CLUSTERS = 64 # requested no. of clusters
+ENGINES = ("km","bkm","mkm","kmd")
+REDIMSIZE = 64 # pca size for the pictures and the pca scenario
+KMDMAX = 100000 # max. scale for the kmd (its samples grow with k, not the scale)
+REPEATS = 1 # runs per scenario, the fastest one counts
+THRESHOLD = 10 # regression threshold in percent
+MINWALL = 0.1 # min. time of the stage in the baseline to be compared (seconds)
+WORKDIR = "/tmp/imbench"
+
+# ------------------------------------------------------------------------------------
+
+def vtime(): return time.clock_gettime(time.CLOCK_MONOTONIC)
+
+def MSG1(str): print(f"{str:>18s}:",end=" ",file=sys.stderr)	# start
+def MSG2(str): print(str,end=" ",file=sys.stderr)		# continue
+def MSG3(str): print(str,file=sys.stderr)			# end
+def MSG(hdr,str): MSG1(hdr); MSG3(str)				# hdr+string util function
+def MSGE(str): MSG1("error"); MSG3(str); exit(1)		# error util function
+
+# return time interval
+def minsec(sec):
+  ret = None
+  if sec > 3600: ret = f"{sec/3600:.1f}hr"
+  elif sec > 60: ret = f"{sec/60:.1f}min"
+  else:		 ret = f"{sec:.2f}sec"
+  return ret
+
+# return metric number
+def metric(num):
+  if num > 1073741824: return f"{num/1073741824:.1f}G"
+  if num > 1048576:    return f"{num/1048576:.1f}M"
+  if num > 1024:       return f"{num/1024:.1f}k"
+  return f"{num:.0f}"
+
+# ------------------------------------------------------------------------------------
+# include "VERSION.py"
+
+HELP = f"""
+NAME
+    imbench - benchmark the imclust pipeline
+
+USAGE
+    imbench [OPTIONS]
+
+DESCRIPTION
+    Imbench generates synthetic data sets (gaussian groups of precomputed
+    -vec vectors, and pictures of colored blobs for up to {IMAGES} images)
+    at given scales, runs imclust scenarios on them with the profiling
+    (-pf), and reports per-stage wall time, throughput and peak memory.
+    All runs are offline on CPU: pictures go through the "none" model
+    (raw pixels), no model weights are needed.
+
+    Data are generated once per scale with a fixed seed and reused by next
+    runs.  Results can be saved as the baseline and compared with later
+    runs, stages slower than the threshold are marked by "!".
+
+SCENARIOS
+     img  pictures, none model, pca to {REDIMSIZE}, cold cache (load-resize, perceive,
+          pca fit and transform, cache save)
+    imgc  the same with the warm cache (load of cached vectors)
+     vec  precomputed vectors, cold cache (read of raw vectors)
+     pca  precomputed vectors reduced by pca to {REDIMSIZE}
+   ENGINE clustering of precomputed vectors by the engine (km, bkm, ...),
+          the kmd up to {KMDMAX} images
+
+    Every scenario is timed in stages as profiled by imclust: scan, cache
+    status (caching_init), load (with cache load, image load, perceive,
+    reduce and cache save times), reduction (pca fit), clustering, tsp,
+    csort, output and metric.
+
+OPTIONS
+      -h  This help.
+ -n NUMS  Scales, comma separated, dflt. {",".join(str(s) for s in SCALES)}, like 10k,100k,1M.
+ -ni NUM  Max. no. of pictures per scale, dflt. {IMAGES}.
+ -vs NUM  Size of vectors, dflt. {VSIZE}.
+  -c NUM  No. of clusters, dflt. {CLUSTERS}.
+ -cl STR  Engines, dflt. {",".join(ENGINES)}.
+  -s STR  Scenarios to run (comma separated), dflt. all.
+  -r NUM  Repeats of every scenario, dflt. {REPEATS} (the fastest counts).
+  -j NUM  Threads of imclust.
+  -d DIR  Work directory, dflt. {WORKDIR}.
+  -o FILE Write results into the json FILE (like a new baseline).
+  -b FILE Compare with the baseline json FILE.
+  -t PERC Regression threshold, dflt. {THRESHOLD} % (stages over {MINWALL}sec in the baseline).
+     -cc  Clean the generated data and exit.
+
+EXAMPLES
+
+  imbench -n 10k,100k -o base.json
+  imbench -n 10k,100k -b base.json
+
+VERSION
+    imbench {VERSION} (c) R.Jaksa 2021
+"""
+
+import argparse
+parser = argparse.ArgumentParser(add_help=False)
+parser.add_argument("-h","--help",action="store_true")
+parser.add_argument("-n","--scales",type=str)
+parser.add_argument("-ni","--images",type=int)
+parser.add_argument("-vs","--vsize",type=int)
+parser.add_argument("-c","--clusters",type=int)
+parser.add_argument("-cl","--engines",type=str)
+parser.add_argument("-s","--scenarios",type=str)
+parser.add_argument("-r","--repeats",type=int)
+parser.add_argument("-j","--threads",type=int)
+parser.add_argument("-d","--workdir",type=str,default=WORKDIR)
+parser.add_argument("-o","--output",type=str)
+parser.add_argument("-b","--baseline",type=str)
+parser.add_argument("-t","--threshold",type=float)
+parser.add_argument("-cc","--clean",action="store_true")
+args = parser.parse_args()
+
+if args.help:
+  print(HELP)
+  exit(0)
+
+# scale from string like 10k or 1M
+def scale(s):
+  m = re.match("([0-9.]+)([kM]?)$",s)
+  if not m: MSGE(f"wrong scale {s}")
+  return int(float(m[1])*{"":1,"k":1000,"M":1000000}[m[2]])
+
+if args.scales: SCALES = [scale(s) for s in args.scales.split(",")]
+if args.images is not None: IMAGES = args.images
+if args.vsize: VSIZE = args.vsize
+if args.clusters: CLUSTERS = args.clusters
+if args.engines: ENGINES = args.engines.split(",")
+if args.repeats: REPEATS = args.repeats
+if args.threshold is not None: THRESHOLD = args.threshold
+SCENARIOS = ("img","imgc","vec","pca",*ENGINES)
+if args.scenarios: SCENARIOS = args.scenarios.split(",")
+
+IMCLUST = f"{os.path.dirname(os.path.abspath(__file__))}/imclust"
+if not os.path.exists(IMCLUST): MSGE(f"imclust not found in {IMCLUST}")
+
+if args.clean:
+  shutil.rmtree(args.workdir,ignore_errors=True)
+  MSG("cleaned",args.workdir)
+  exit(0)
+
+# ---------------------------------------------------------------------- synthetic data
+# images are in subdirs of 10000 (to keep directories small), the data dir of the scale
+# is complete when its .done file exists
+
+SUBDIR = 10000
+
+# path of the i-th image of the data set (without the suffix)
+def dpath(ddir,i): return f"{ddir}/{i//SUBDIR:03d}/{i:07d}"
+
+# gaussian groups: centers, and the group of every image
+def groups(n,rng):
+  centers = rng.normal(0,1,(GROUPS,VSIZE)).astype(np.float32)
+  return centers,rng.integers(GROUPS,size=n)
+
+# precomputed vectors of n images into .vec files, in batches, with empty .png files
+# (imclust scans for pictures and reads their vectors)
+def gen_vectors(ddir,n,rng):
+  centers,group = groups(n,rng)
+  for i in range(0,n,SUBDIR):
+    os.makedirs(os.path.dirname(dpath(ddir,i)),exist_ok=True)
+    V = centers[group[i:i+SUBDIR]] + rng.normal(0,0.5,(len(group[i:i+SUBDIR]),VSIZE)).astype(np.float32)
+    for j,v in enumerate(V):
+      v.tofile(f"{dpath(ddir,i+j)}.vec")
+      open(f"{dpath(ddir,i+j)}.png","w").close()
+
+# pictures of n images: blobs of the group color on the noisy background
+def gen_pictures(ddir,n,rng):
+  from PIL import Image
+  colors = rng.integers(0,256,(GROUPS,2,3))
+  _,group = groups(n,rng)
+  y,x = np.mgrid[0:ISIZE,0:ISIZE]
+  for i in range(n):
+    os.makedirs(os.path.dirname(dpath(ddir,i)),exist_ok=True)
+    c = colors[group[i]]
+    cy,cx,r = rng.integers(ISIZE//4,3*ISIZE//4,size=2).tolist()+[ISIZE//4]
+    blob = ((y-cy)**2 + (x-cx)**2 < r*r)[:,:,None]
+    image = np.where(blob,c[0],c[1]) + rng.normal(0,16,(ISIZE,ISIZE,3))
+    Image.fromarray(np.clip(image,0,255).astype(np.uint8)).save(f"{dpath(ddir,i)}.png")
+
+# data dirs of the scale: (vectors,pictures), generated if needed
+def dataset(n):
+  vdir = f"{args.workdir}/vec{n}-{VSIZE}"
+  idir = f"{args.workdir}/img{min(n,IMAGES)}-{ISIZE}"
+  for ddir,gen,m in ((vdir,gen_vectors,n),(idir,gen_pictures,min(n,IMAGES))):
+    if os.path.exists(f"{ddir}.done") or not m: continue
+    MSG1("generate"); MSG2(f"{m} {'vectors' if gen == gen_vectors else 'pictures'} into {ddir}"); T0 = vtime()
+    shutil.rmtree(ddir,ignore_errors=True)
+    gen(ddir,m,np.random.default_rng(n))
+    open(f"{ddir}.done","w").close()
+    MSG3(f"in {minsec(vtime()-T0)}")
+  return vdir,idir
+
+# ---------------------------------------------------------------------------- scenarios
+
+# imclust arguments of the scenario, or None if not applicable
+def scenario(name,n,vdir,idir):
+  out = f"{args.workdir}/out/{name}{n}"
+  common = ["-c",str(CLUSTERS),"-rs","1","-pf","-o",out]
+  if args.threads: common += ["-j",str(args.threads)]
+  if name in ("img","imgc"):
+    if not IMAGES: return None
+    return ["-nn","none","-r",str(REDIMSIZE),"-cd",f"{out}.cache",*common,idir]
+  if name == "vec": return ["-vec","vec","-nc",*common,vdir]
+  if name == "pca": return ["-vec","vec","-nc","-rd","pca","-r",str(REDIMSIZE),*common,vdir]
+  if name == "kmd" and n > KMDMAX: return None
+  return ["-vec","vec","-nc","-cl",name,"-cs","dist","-nm",*common,vdir]
+
+# run imclust, return its profile records: (header,records)
+def run(name,cmd):
+  out = cmd[cmd.index("-o")+1]
+  os.makedirs(os.path.dirname(out),exist_ok=True)
+  if name == "img": shutil.rmtree(f"{out}.cache",ignore_errors=True)
+  if name == "imgc": cmd[cmd.index("-cd")+1] = f"{re.sub('imgc','img',out)}.cache"
+  for f in glob.glob(f"{out}.*prof.jsonl"): os.remove(f)
+  res = subprocess.run([sys.executable,IMCLUST,*cmd],stdout=subprocess.DEVNULL,stderr=subprocess.PIPE,text=True)
+  files = glob.glob(f"{out}.*prof.jsonl")
+  if res.returncode or not files:
+    MSG3("failed"); MSG3(res.stderr[-2000:]); return None
+  with open(files[0]) as fd: lines = [json.loads(line) for line in fd]
+  return lines[0],lines[1:]
+
+# stages of the run: name -> {wall,ips,rss}, load times become "load/TIME" sub-stages
+def stages(header,records):
+  st = {"total":{"wall":header["wall"],"rss":header["rss"]}}
+  for r in records:
+    if "batch" in r or r["wall"] < 0.001: continue	# batches and void stages
+    st[r["stage"]] = {k:r[k] for k in ("wall","ips","rss") if k in r}
+    if r["wall"] < 0.01: st[r["stage"]].pop("ips",None)	# too short to say
+    for k,v in r.get("times",{}).items():
+      if v: st[f"load/{k}"] = {"wall":v}
+  return st
+
+# the fastest of repeated runs of the scenario
+def bench(name,n,cmd):
+  best = None
+  for i in range(REPEATS):
+    if name == "img" and i: shutil.rmtree(f"{cmd[cmd.index('-o')+1]}.cache",ignore_errors=True)
+    prof = run(name,list(cmd))
+    if prof is None: return None
+    st = stages(*prof)
+    if best is None or st["total"]["wall"] < best["total"]["wall"]: best = st
+  return best
+
+# ------------------------------------------------------------------------------ report
+
+# ratio of the stage time to the baseline, None if not comparable
+def ratio(key,stage,st):
+  if not base or not stage in base.get(key,{}) or base[key][stage]["wall"] < MINWALL: return None
+  return st["wall"]/base[key][stage]["wall"]
+
+# the stage line: wall, images per second, peak RAM, and the ratio to the baseline
+def report(key,stage,st):
+  line = f"{minsec(st['wall']):>9s}"
+  line += f" {metric(st['ips']):>7s}/s" if "ips" in st else " "*9
+  line += f" {metric(st['rss'])+'B':>7s}" if "rss" in st else " "*8
+  r = ratio(key,stage,st)
+  if r is not None: line += f"  {r:5.2f}x" + (" !" if r > 1+THRESHOLD/100 else "")
+  MSG(stage,line)
+
+base = None
+if args.baseline:
+  with open(args.baseline) as fd: base = json.load(fd)["results"]
+
+results = {}
+slower = 0
+for n in SCALES:
+  vdir,idir = dataset(n)
+  for name in SCENARIOS:
+    cmd = scenario(name,n,vdir,idir)
+    if cmd is None: continue
+    key = f"{name} {n}"
+    MSG1(key); MSG2(f"imclust {' '.join(cmd[:-1])}"); MSG3("")
+    st = bench(name,n,cmd)
+    if st is None: continue
+    results[key] = st
+    for stage in st:
+      report(key,stage,st[stage])
+      slower += (ratio(key,stage,st[stage]) or 0) > 1+THRESHOLD/100
+
+if args.output:
+  with open(args.output,"w") as fd:
+    json.dump({"version":VERSION,"machine":platform.node(),"cpus":os.cpu_count(),"python":platform.python_version(),
+      "numpy":np.__version__,"threshold":THRESHOLD,"results":results},fd,indent=1)
+  MSG("results",args.output)
+if base:
+  MSG("regressions",f"{slower} stages slower than {THRESHOLD:g} % over the baseline")
+  if slower: exit(2)
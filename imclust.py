@@ -1,8 +1,10 @@
 #!/usr/bin/env -S python3 -u # -*- python -*-
-import os,sys,time,re,types
+import os,sys,time,re,types,resource,importlib
+T00 = time.clock_gettime(time.CLOCK_MONOTONIC) # start of the script
 
 # import a silent numpy
 import numpy as np
+TNUMPY = time.clock_gettime(time.CLOCK_MONOTONIC)-T00
 np.warnings.filterwarnings("ignore",category=np.VisibleDeprecationWarning)
 
 # available vs. default perception models (to transform input picture into vector of numbers)
@@ -10,12 +12,17 @@ MODELS  = ("none","resnet50","resnet152v2","vgg16","inceptionv3","efficientnetb6
 MODELS += ("densenet121","densenet169","densenet201")
 MODEL   = "densenet201"
 
+# available vs. default spatial pooling of perception feature maps (g2 = 2x2 grid)
+POOLS = ("none","avg","max","gem","g2","g3")
+POOL = "none"
+GEMP = 3 # GeM pooling power
+
 # available vs. default dimensionality reduction methods
-REDIMS = ("none","pca") # TODO: autoencoders
+REDIMS = ("none","pca","rpca","ipca") # TODO: autoencoders
 REDIM = "pca"
 
 # available vs. default clustering methods
-CLUSTS = ("km","bkm","kmd")
+CLUSTS = ("km","bkm","mkm","kmd","knn")
 CLUST = "km"
 CLUSTERS = 128 # default no. of clusters
 CMULT = 1.1 # min ratio of images to clusters (2 = in average 2 images per cluster)
@@ -24,9 +31,25 @@ CMULT = 1.1 # min ratio of images to clusters (2 = in average 2 images per clust
 SORTS = ("none","size","tsp")
 SORT = "tsp"
 
-# TODO: available vs. default intra-cluster sorting methods
+# available vs. default image loaders
+LOADERS = ("ski","pil")
+LOADER = "ski"
+
+# available vs. default keys of cache files
+CKEYS = ("name","stat","hash")
+CKEY = "name"
+
+# available vs. default encodings of cached vectors
+QUANTS = ("f32","f16","i8")
+QUANT = "f32"
+
+# time budget for the tsp ordering (seconds)
+TSPTIME = 10
+
+# available vs. default intra-cluster sorting methods
 CSORTS = ("none","dist","tsp")
 CSORT = "tsp"
+CSORTMAX = 2048 # max. cluster size for the tsp, bigger clusters are sorted by dist
 
 # TODO: available vs. default clustering evaluation methods
 EVALS = ("none","tsp")
@@ -41,6 +64,9 @@ BATCHSIZE = 2048
 REDIMSIZE = 3072 # target size of vector after reduction
 REDIMPATS = 8192 # number of patterns to train "reductor"
 
+# no. of clusters per html page
+HTMLPAGE = 128
+
 # no. of loading threads
 THREADS = 8
 
@@ -61,6 +87,19 @@ def MSGP(j): # progress-overwrite function, j is progress index
   if (j+1)%10==0: ch = ":"
   MSGC(f"\b{ch}")
 
+# import module lazily, only when its stage runs, and remember the import time
+IMPORTS = {} # module name -> import time
+def timport(name):
+  if name in sys.modules: return sys.modules[name]
+  T = vtime()
+  module = importlib.import_module(name)
+  IMPORTS[name] = vtime()-T
+  return module
+
+# MSG print of import times of lazily imported modules
+def MSGimports():
+  if IMPORTS: MSG("import times",", ".join(f"{k} {minsec(v)}" for k,v in IMPORTS.items()))
+
 # return metric number
 def metric(num):
   ret = None
@@ -75,6 +114,9 @@ def metric(num):
   ret = re.sub("\.0([GMk])?$",r"\1",ret)
   return ret
 
+# return peak resident memory of the process in bytes (ru_maxrss is in kB on linux)
+def peakram(): return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
 # return time interval
 def minsec(sec):
   ret = None
@@ -123,40 +165,97 @@ CACHING
     for cache files.  Explicit cache directory can by requested by -cd,
     or no caching by -nc.
 
+    Cache files are named after the image file name, so images of the same
+    name from different directories collide in a common cache dir.  The -ck
+    stat names them by the fingerprint of path, size and mtime, and -ck hash
+    by the hash of the file content.  Keys are remembered in the keys-*.idx
+    index and recomputed only for changed files.
+
 OPTIONS
       -h  This help.
       -v  Verbose.
       -f  Force recomputing all data, avoid cached.
    -html  Write html output instead of CSV.
+ -hp NUM  Clusters per html page, dflt. {HTMLPAGE}, next pages are PATH.2.html etc.
  -o PATH  The base of the output file name.
   -j NUM  Number of threads for loading, dflt. {THREADS}.
+     -jp  Use processes instead of threads for loading.
+ -ld STR  Image loader, dflt. {LOADER} (from {", ".join(LOADERS)}), the pil
+          decodes jpegs directly in reduced resolution (faster).
  -cd DIR  Cache directory to use.
      -nc  Don't cache computed perception nor reduction vectors.
+     -mm  Memory-map the loaded vectors array into a temporary file
+          (in the cache dir if available), instead of keeping it in RAM.
+     -vs  Vector store: cache vectors into single matrix file per suffix
+          (plus index file) in the cache dir, instead of file per image.
+          Without the cache dir the first input directory is used.
+ -ck STR  Keys of cache files, dflt. {CKEY} (from {", ".join(CKEYS)}).
+  -q STR  Encoding of cached vectors, dflt. {QUANT} (from {", ".join(QUANTS)}), the i8
+          is int8 with the scale per vector, f16/i8 also keep the loaded
+          vectors in float16 for the mkm, kmd and knn clustering.
   -c NUM  Requested number of clusters.
+ -ks STR  Sweep the number of clusters (FROM:TO:STEP or K1,K2,...), fit them
+          in parallel on the sample of images, and cluster all images into
+          the best one by silhouette, the scores go to the .sweep.csv file.
   -n NUM  Number of clustering attempts/restarts.
   -m NUM  Limit the max number of images to cluster.
  -mt NUM  Number of members threshold for the cluster to be accepted.
  -dt NUM  Absolute distance threshold from the center cluster, for
           the image to be accepted.
 -pt PERC  Percentual threshold.
+-ad FILE  Add new images (not in the csv yet) to the clustering saved in
+          the .model FILE next to its csv, by the nearest centers.
+-dr PERC  With -ad, cluster all images again when the mean distance of new
+          images from centers exceeds that of the clustering by PERC %.
   -b NUM  Batch size.
   -r NUM  Reduce vector dimensionality to NUM, dflt. auto from {REDIMSIZE}.
  -rp NUM  No. of patterns to train reduction, dflt. auto from {REDIMPATS}.
  -nn STR  Model name, dflt. {MODEL} ({", ".join(MODELS)}).
+ -pl STR  Spatial pooling of the model feature map, dflt. {POOL} (from
+          {", ".join(POOLS)}), avg/max/gem are global, g2 is 2x2 grid.
  -cl STR  Clustering algorithm, dflt. {CLUST} (from {", ".join(CLUSTS)}).
  -rd STR  Dimensionality reduction, dflt. {REDIM} (from {", ".join(REDIMS)}).
+          The rpca is randomized PCA, the ipca is incremental PCA trained
+          batch by batch in bounded memory.
   -s STR  Sorting of cluster centers, dflt. {SORT} (from {", ".join(SORTS)}).
+     -sc  Sort clusters by their centroids, not by the closest images.
+ -cs STR  Sorting of images in clusters, dflt. {CSORT} (from {", ".join(CSORTS)}),
+          dist is by the distance from the center, tsp starts from the
+          closest image and keeps similar images next to each other.
+ -cm NUM  Max. cluster size for the tsp, dflt. {CSORTMAX} (bigger by dist).
+ -tt SEC  Time budget for the tsp sorting, dflt. {TSPTIME}.
+ -rs NUM  Random seed (for images order, clustering and tsp sorting).
 -vec STR  Suffix of files with precomputed vectors for every picture,
           for "dir/f_12.jpg" we expect "dir/f_12.vgg" if STR is "vgg".
           Comma separated list of suffixes is allowed, to concatenate
           several vectors into single input for clustering.
+-dup NUM  Near-duplicates report into the .dup.csv file: groups of images
+          closer than NUM (distance of vectors) to some other image.
      -nm  No metric.
+ -ms NUM  Images sample size for the silhouette, COP and SDbw metrics,
+          dflt. 10000, 0 = all images.
+     -pf  Profile pipeline stages and batches into the .prof.jsonl file.
+ -cp STR  Profile the stage STR by cProfile into the .STR.pstats file,
+          stages: scan, keys, cache status, perception init, reduction,
+          load, assign, sweep, knn graph, clustering, organize, tsp,
+          csort, output, metric.
+ -tm STR  Trace memory allocations of the stage STR by tracemalloc.
     -jpg  Jpg input files only.
+     -jr  Journal the run into the .journal dir next to the output: loaded
+          vectors, the trained reducer, clustering attempts and the result
+          are checkpointed, and the run started again with the same
+          arguments resumes from there (scikit attempts then run one by one).
+-sm FILE  Scan manifest: directories walked by the scan are remembered in
+          the FILE, and those unchanged since (by mtime) are not listed again.
 
 CLUSTERING
       km  scikit KMeans
      bkm  scikit MiniBatchKMeans
-     kmd  scikit KMedoids
+     mkm  native MiniBatchKMeans, streamed from memory-mapped vectors (-mm),
+          float32, attempts run in parallel processes
+     kmd  native KMedoids, FasterPAM on CLARA samples run in parallel
+     knn  Louvain communities of the kNN graph (networkx), the number of
+          clusters is approximate
 
 EXAMPLES
 
@@ -189,11 +288,16 @@ parser = argparse.ArgumentParser(add_help=False)
 parser.add_argument("-h","--help",action="store_true")
 parser.add_argument("-v","--verbose",action="store_true")
 parser.add_argument("-c","--clusters",type=int)
+parser.add_argument("-ks","--sweep",type=str)
 parser.add_argument("-m","--maximum",type=int)
 parser.add_argument("-dt","--distthr",type=int)
 parser.add_argument("-pt","--percthr",type=int)
+parser.add_argument("-ad","--assign",type=str)
+parser.add_argument("-dr","--drift",type=float)
 parser.add_argument("-o","--output",type=str)
 parser.add_argument("-j","--threads",type=int)
+parser.add_argument("-jp","--procs",action="store_true")
+parser.add_argument("-ld","--loader",type=str,default=LOADER)
 parser.add_argument("-n","--attempts",type=int)
 
 parser.add_argument("-b","--batchsize",type=int)
@@ -201,17 +305,35 @@ parser.add_argument("-r","--redimsize",type=int)
 parser.add_argument("-rp","--redimpats",type=int)
 
 parser.add_argument("-nn","--nn",type=str,default=MODEL)
+parser.add_argument("-pl","--pool",type=str,default=POOL)
 parser.add_argument("-cl","--clust",type=str,default=CLUST)
 parser.add_argument("-s","--sort",type=str,default=SORT)
+parser.add_argument("-sc","--centroids",action="store_true")
+parser.add_argument("-cs","--csort",type=str,default=CSORT)
+parser.add_argument("-cm","--csortmax",type=int)
+parser.add_argument("-tt","--tsptime",type=float)
+parser.add_argument("-rs","--seed",type=int)
 parser.add_argument("-rd","--redim",type=str)
 
 parser.add_argument("-vec","--vectors",type=str)
 parser.add_argument("-nc","--nocache",action="store_true")
+parser.add_argument("-mm","--mmap",action="store_true")
+parser.add_argument("-vs","--store",action="store_true")
+parser.add_argument("-ck","--ckeys",type=str,default=CKEY)
+parser.add_argument("-q","--quant",type=str,default=QUANT)
 parser.add_argument("-cd","--cachedir",type=str,default="")
+parser.add_argument("-dup","--dup",type=float)
 parser.add_argument("-nm","--nometric",action="store_true")
+parser.add_argument("-pf","--prof",action="store_true")
+parser.add_argument("-cp","--cprof",type=str)
+parser.add_argument("-tm","--tmem",type=str)
+parser.add_argument("-ms","--msample",type=int)
 parser.add_argument("-jpg","--jpgonly",action="store_true")
+parser.add_argument("-sm","--manifest",type=str)
+parser.add_argument("-jr","--journal",action="store_true")
 
 parser.add_argument("-html","--html",action="store_true")
+parser.add_argument("-hp","--htmlpage",type=int)
 
 parser.add_argument("paths",type=str,nargs='*')
 args = parser.parse_args()
@@ -222,10 +344,20 @@ if args.help:
 
 VERBOSE = 1 if args.verbose else 0
 if args.threads: THREADS = args.threads
+if args.htmlpage: HTMLPAGE = args.htmlpage
+if args.tsptime: TSPTIME = args.tsptime
+if args.csortmax: CSORTMAX = args.csortmax
+if VERBOSE: MSG("startup",f"numpy {minsec(TNUMPY)}, total {minsec(vtime()-T00)}")
 
 if not args.nn in MODELS: MSGE(f"unknown perc. model {args.nn}")
 else: MODEL = args.nn
 
+if not args.pool in POOLS: MSGE(f"unknown pooling {args.pool}")
+elif MODEL != "none" and not args.vectors: POOL = args.pool
+
+# suffix of the perception cache files
+MODELSX = MODEL if POOL == "none" else f"{MODEL}-{POOL}"
+
 if not args.clust in CLUSTS: MSGE(f"unknown clustering {args.clust}")
 else: CLUST = args.clust
 
@@ -237,19 +369,38 @@ else: REDIM = args.redim
 if not args.sort in SORTS: MSGE(f"unknown sorting {args.sort}")
 else: SORT = args.sort
 
+if not args.csort in CSORTS: MSGE(f"unknown intra-cluster sorting {args.csort}")
+else: CSORT = args.csort
+
+if not args.loader in LOADERS: MSGE(f"unknown loader {args.loader}")
+else: LOADER = args.loader
+
+if not args.ckeys in CKEYS: MSGE(f"unknown cache keys {args.ckeys}")
+else: CKEY = args.ckeys
+
+if not args.quant in QUANTS: MSGE(f"unknown cache encoding {args.quant}")
+else: QUANT = args.quant
+
+# include "prof.py"
+prof_init()
+
+# include "assign.py"
+if args.assign: assign_init(args.assign)
+
 # -------------------------------------------------------------------------- filenames
 
 if args.verbose:
   MSG("reqeusted paths",f"{', '.join(args.paths)}")
 
-# output filename
-def outputname():
+# output filename, clusters is the string to use instead of the number of clusters
+def outputname(clusters=None):
+  if AMODEL: return re.sub("\.csv$","",AMODEL["output"])
   if args.output: output = args.output
   else:		  output = f"{args.paths[0]}"
 
-  if CLUST != "none":   output += f".{CLUST}{CLUSTERS}"
+  if CLUST != "none":   output += f".{CLUST}{CLUSTERS if clusters is None else clusters}"
   if args.vectors:      output += f".{re.sub(',','-',args.vectors)}"
-  elif MODEL != "none": output += f".{MODEL}"
+  elif MODEL != "none": output += f".{MODELSX}"
   if REDIM != "none":   output += f"-{REDIM}{REDIMSIZE}"
 # if SORT  != "none":   output += f".{SORT}"
 
@@ -261,40 +412,13 @@ if args.clusters: CLUSTERS = args.clusters
 MSG("expected name",f"{outputname()}")
 
 # ------------------------------------------------------------------ get list of files
-from glob import glob
+# include "scan.py"
 import random
 
-MSG1("scan paths")
-paths = [] # paths to pictures
-poor = [] # wrong/missing paths
-for name in args.paths:
-
-  # 1st: from CSV (use the 1st column and expect filenames)
-  if re.search("\.csv$",name):
-    for file in os.popen(f"cut -d ' ' -f 1 {name}").read().rstrip().split("\n"):
-      if file[0] == "#": continue
-      if os.path.exists(file): paths.append(file)
-      else: poor.append(file)
-
-  # 2nd: explicit jpg filenames
-  elif re.search("\.jpg$",name):
-    if os.path.exists(name): paths.append(name)
-    else: poor.append(name)
-
-  # 3rd: explicit png filenames
-  elif not args.jpgonly and re.search("\.png$",name):
-    if os.path.exists(name): paths.append(name)
-    else: poor.append(name)
-
-  # 4th: recursive directory search
-  elif os.path.isdir(name):
-    paths += glob(name+"/**/*.jpg",recursive=True)
-    if not args.jpgonly:
-      paths += glob(name+"/**/*.png",recursive=True)
-
-  else: poor.append(name)
-
+MSG1("scan paths"); prof_start("scan")
+paths,poor,listed,walked = scan_paths(args.paths,args.manifest) # paths to pictures, wrong/missing paths
 MSG2(f"{len(paths)} pictures")
+if args.manifest and walked: MSG2(f"({walked-listed} of {walked} dirs from manifest)")
 
 # limit the number of files to process
 if args.maximum and args.maximum < len(paths):
@@ -308,23 +432,25 @@ if poor:
 if len(paths)<1:
   MSGE("cannot proceed without files")
 
-# remove duplicates and shuffle
-paths = list(set(paths))
-random.shuffle(paths)
+# shuffle (paths are unique and sorted)
+random.Random(args.seed).shuffle(paths)
+if AMODEL: paths = assign_filter(paths)
+prof_stop("scan",images=len(paths))
 
 #for p in paths: print(p)
 # --------------------------------------------------------------------- batching setup
 # include "perception.py"
 
 isize,osize,vsize = modelsize(MODEL)
+osize,vsize = poolsize(osize,POOL)
 
 if args.batchsize: BATCHSIZE = args.batchsize
 if args.redimsize: REDIMSIZE = args.redimsize
 if args.redimpats: REDIMPATS = args.redimpats
 
-if BATCHSIZE > len(paths): BATCHSIZE = len(paths)
+if BATCHSIZE > len(paths) and not AMODEL: BATCHSIZE = len(paths)
 if REDIMPATS > len(paths): REDIMPATS = len(paths)
-if REDIMSIZE > REDIMPATS: REDIMSIZE = REDIMPATS
+if REDIMSIZE > REDIMPATS and not AMODEL: REDIMSIZE = REDIMPATS
 
 MSG("batch size",f"{BATCHSIZE} (aprox. {len(paths)/BATCHSIZE:.0f} batches)")
 
@@ -346,33 +472,84 @@ if args.cache:
   dir = args.cachedir if args.cachedir!="" else "input dir"
   MSG("will cache to",dir)
 
+# dir for the vector store and cache keys index: the cache dir, or the first input dir
+args.storedir = args.cachedir
+if args.storedir == "": args.storedir = args.paths[0] if os.path.isdir(args.paths[0]) else os.path.dirname(args.paths[0])
+if args.storedir == "": args.storedir = "."
+
 # -------------------------------------- cached loading of images till reduced vectors
 # include "cache.py"
 # include "reduction.py"
 # include "loading.py"
-
-if args.vectors:
-  cache,vsize = caching_init_prec(paths,args.vectors,args.cachedir,REDIM,REDIMSIZE)
-  MODEL = "none"
-else:
-  cache = caching_init(paths,MODEL,args.cachedir,REDIM,REDIMSIZE)
-
-REDIMSIZE = min(REDIMSIZE,vsize) # further reduce REDIMSIZE if vector size is too small
+# include "journal.py"
+
+# the reducer is trained on images out of quarantine only
+if not AMODEL and REDIM != "none":
+  ntrain = max(1,len(paths) - quarantine_count(paths))
+  if REDIMPATS > ntrain: REDIMPATS = ntrain
+  if REDIMSIZE > REDIMPATS: REDIMSIZE = REDIMPATS
+
+journal_init(paths)
+
+# loaded vectors are float16 for engines streaming them by batches in float32
+VDTYPE = np.float16 if QUANT != "f32" and CLUST in ("mkm","kmd","knn") else np.float32
+
+# return vectors of images and their paths, reordered the same way as vectors
+def vectors_load(paths):
+  global cache,prcpt,redim,vsize,MODEL,REDIMSIZE
+  keys = None
+  if CKEY != "name":
+    prof_start("keys")
+    keys = ckeys_init(paths,CKEY,args.storedir)
+    prof_stop("keys",images=len(paths))
+
+  prof_start("cache status")
+  if args.vectors:
+    cache,vsize = caching_init_prec(paths,args.vectors,args.cachedir,REDIM,REDIMSIZE,keys)
+    MODEL = "none"
+  else:
+    cache = caching_init(paths,MODELSX,args.cachedir,REDIM,REDIMSIZE,keys)
+  journal_skip(cache)
+  prof_stop("cache status",images=len(paths),reduced=len(cache.paths2),percepts=len(cache.paths1),
+    pictures=len(cache.paths0),hitrate=round(1-len(cache.paths0)/max(1,len(paths)),4))
+
+  REDIMSIZE = min(REDIMSIZE,vsize) # further reduce REDIMSIZE if vector size is too small
   
-prcpt = perception_init(cache,MODEL,isize,osize,vsize)
-redim =  reduction_init(cache,prcpt,REDIM,REDIMSIZE,REDIMPATS)
-vectors =     data_load(cache,prcpt,redim)
-
-# reorder paths, to have the "paths" in the same as "vectors" from loading
-paths = []
-for path in cache.paths2: paths.append(path)
-for path in cache.paths1: paths.append(path)
-for path in cache.paths0: paths.append(path)
+  # start loading processes before tensorflow starts its threads
+  if args.procs and cache.paths0all: lrpool()
+
+  prof_start("perception init")
+  prcpt = perception_init(cache,MODEL,POOL,isize,osize,vsize)
+  prof_stop("perception init")
+  prof_start("reduction")
+  redim =  reduction_init(cache,prcpt,REDIM,REDIMSIZE,REDIMPATS)
+  prof_stop("reduction")
+  prof_start("load")
+  vectors =     data_load(cache,prcpt,redim)
+  prof_stop("load",images=len(vectors),bytes=vectors.nbytes)
+
+  # reorder paths, to have the "paths" in the same as "vectors" from loading
+  paths = list(cache.done)
+  for path in cache.paths2: paths.append(path)
+  for path in cache.paths1: paths.append(path)
+  for path in cache.paths0: paths.append(path)
+  return vectors,paths
+
+vectors,paths = vectors_load(paths)
+
+# new images assigned to the saved clustering, or all images clustered again
+if AMODEL:
+  prof_start("assign")
+  drift = assign(vectors,paths)
+  prof_stop("assign",images=len(vectors),drift=drift)
+  if drift is not None:
+    if VERBOSE: MSGimports()
+    exit(0)
+  vectors,paths = vectors_load(assign_known()+paths)
 
 IMAGES = len(vectors)
 
 # ----------------------------------------------------------------------- cluster them
-MSG1("clustering")
 
 maxcl = int(len(paths)/CMULT)				# max. allowed no. of clusters
 if len(paths)<2048: CLUSTERS = int(len(paths)/16)	# default for small no. of files
@@ -380,94 +557,147 @@ if args.clusters:   CLUSTERS = args.clusters		# requested no. of clusters
 if CLUSTERS>maxcl:  CLUSTERS = maxcl			# limited by CMULT
 if CLUSTERS<2:	    CLUSTERS = 2			# at least two
 
+# include "kmeans.py"
+# include "kmedoids.py"
+# include "tsp.py"
+# include "ann.py"
+
+# return the clustering engine for k clusters and its description, init are the
+# initial centers (then a single attempt is enough), ignored by kmd and knn
+def clust_engine(k,init=None):
+
+  # K-means using squared distances
+  if CLUST == "km":
+    cluster = timport("sklearn.cluster")
+    n_init = 10
+    n_init = 2 if IMAGES>8000 else n_init
+    n_init = args.attempts if args.attempts else n_init
+    if init is not None: n_init = 1
+    clust = cluster.KMeans(n_clusters=k,verbose=VERBOSE,n_init=n_init,init="k-means++" if init is None else init,random_state=args.seed)
+    return clust,f"scikit KMeans {k} clusters in {n_init} attempts"
+
+  if CLUST == "bkm":
+    cluster = timport("sklearn.cluster")
+    n_init = 2
+    n_init = 10 if k<2001 else n_init
+    n_init = 100 if k<101 else n_init
+    n_init = args.attempts if args.attempts else n_init
+    if init is not None: n_init = 1
+    clust = cluster.MiniBatchKMeans(n_clusters=k,verbose=VERBOSE,n_init=n_init,init="k-means++" if init is None else init,random_state=args.seed)
+    return clust,f"scikit MiniBatchKMeans {k} clusters in {n_init} attempts"
+
+  # native mini-batch K-means, attempts in parallel (so as many as processes)
+  if CLUST == "mkm":
+    n_init = args.attempts if args.attempts else THREADS
+    if init is not None: n_init = 1
+    clust = mkm_engine(k,n_init,init,args.seed,VERBOSE)
+    return clust,f"native MiniBatchKMeans {k} clusters in {n_init} attempts"
+
+  # K-medoids using absolute distances, CLARA samples in parallel
+  if CLUST == "kmd":
+    n_init = args.attempts if args.attempts else max(5,THREADS)
+    m,mem = kmd_size(IMAGES,k)
+    clust = kmd_engine(k,n_init,args.seed,VERBOSE)
+    return clust,f"native KMedoids {k} clusters from {n_init} samples of {m} ({metric(mem)}B each)"
+
+  # communities of the kNN graph
+  if CLUST == "knn":
+    clust = knn_engine(k,args.seed,VERBOSE)
+    return clust,f"Louvain communities of the kNN graph, aiming at {k} clusters"
+
+# fit the engine to X, with the run journal its attempts are checkpointed (then scikit
+# attempts run one by one, from seeds drawn by the -rs seed)
+def clust_fit(clust,X):
+  if not JOURNAL: return clust.fit(X)
+  if CLUST in ("mkm","kmd"): clust.journal = "attempt"
+  if not CLUST in ("km","bkm") or clust.n_init == 1: return clust.fit(X)
+  clone = timport("sklearn.base").clone
+  def attempt(seed):
+    c = clone(clust).set_params(n_init=1,random_state=int(seed)).fit(X)
+    return {k:v for k,v in vars(c).items() if k[-1] == "_" and k[0] != "_"}
+  seeds = np.random.default_rng(args.seed).integers(1<<31,size=clust.n_init)
+  runs = journal_map("attempt",attempt,[(s,) for s in seeds])
+  for k,v in min(runs,key=lambda r: r["inertia_"]).items(): setattr(clust,k,v)
+  return clust
+
+# sweep of the number of clusters, the best one is then fitted on all images
+# include "sweep.py"
+init = None
+if args.sweep:
+  ks = sorted(set(k for k in sweep_parse(args.sweep) if 2 <= k <= maxcl))
+  if not ks: MSGE(f"no numbers of clusters to sweep in {args.sweep} (max. {maxcl})")
+  prof_start("sweep")
+  CLUSTERS,init = sweep(ks)
+  prof_stop("sweep",values=ks,best=CLUSTERS)
+
+# near-duplicates report, and the kNN graph for the knn clustering
+prof_start("knn graph")
+if args.dup is not None: ann_dup(vectors,args.dup,f"{outputname()}.dup.csv")
+if CLUST == "knn": ann_graph(vectors)
+prof_stop("knn graph")
+
+MSG1("clustering"); prof_start("clustering")
 T0 = vtime()
-
-# K-means using squared distances
-if CLUST == "km":
-  from sklearn import cluster
-  n_init = 10
-  n_init = 2 if IMAGES>8000 else n_init
-  n_init = args.attempts if args.attempts else n_init
-  clust = cluster.KMeans(n_clusters=CLUSTERS,verbose=VERBOSE,n_init=n_init)
-  MSG2(f"scikit KMeans {CLUSTERS} clusters in {n_init} attempts")
-
-if CLUST == "bkm":
-  from sklearn import cluster
-  n_init = 2
-  n_init = 10 if CLUSTERS<2001 else n_init
-  n_init = 100 if CLUSTERS<101 else n_init
-  n_init = args.attempts if args.attempts else n_init
-  clust = cluster.MiniBatchKMeans(n_clusters=CLUSTERS,verbose=VERBOSE,n_init=n_init)
-  MSG2(f"scikit MiniBatchKMeans {CLUSTERS} clusters in {n_init} attempts")
-
-# K-medoids using absolute distances
-if CLUST == "kmd":
-  from sklearn_extra import cluster
-  clust = cluster.KMedoids(n_clusters=CLUSTERS)
-  MSG2(f"scikit KMedoids {CLUSTERS} clusters")
-
-# clustering itself
-dists = clust.fit_transform(vectors) # distances to all cluster centers
-idx = clust.predict(vectors)	     # indexes of corresponding clusters
+clust,desc = clust_engine(CLUSTERS,init)
+if init is None: MSG2(desc)
+elif CLUST in ("kmd","knn"): MSG2(f"{desc}, K from the sweep") # they don't start from centers
+else: MSG2(f"{desc} from the sweep")
+
+# clustering itself, or its result from the journal
+fitted = journal_get("clustering")
+if fitted is not None:
+  for k,v in fitted.items(): setattr(clust,k,v)
+  MSG2("(from the journal)")
+else:
+  clust_fit(clust,vectors)
+  journal_put("clustering",{k:v for k,v in vars(clust).items() if k[-1] == "_" and k[0] != "_"})
+idx = clust.labels_		     # indexes of corresponding clusters
+CLUSTERS = len(clust.cluster_centers_) # as found by the knn clustering
 inertia = clust.inertia_	     # method-specific distance of samples to centers
 MSG3(f"in {minsec(vtime()-T0)} inertia={inertia:.2f}")
+prof_stop("clustering",images=IMAGES,clusters=CLUSTERS,engine=CLUST,inertia=inertia)
 
-# distances to the closest cluster
-dist = [np.inf] * IMAGES
-for i in range(IMAGES):
-  dist[i] = dists[i][idx[i]]
-  #print(f"{i} {idx[i]} {dist[i]}")
+# distances to the closest cluster (computed by batches, to not copy all vectors)
+dist = np.empty(IMAGES,dtype=np.float32)
+for i in range(0,IMAGES,BATCHSIZE):
+  dist[i:i+BATCHSIZE] = np.linalg.norm(vectors[i:i+BATCHSIZE]-clust.cluster_centers_[idx[i:i+BATCHSIZE]],axis=1)
 
 # ------------------------------------------------------------------ organize clusters
+prof_start("organize")
 
-# get per-cluster indexes and distances (needed to allow sorting)
-cluster = []
-cdist = []
-for j in range(CLUSTERS):
-  cluster.append([])
-  cdist.append([])
-for i in range(IMAGES):
-  j = idx[i]
-  cluster[j].append(i)
-  cdist[j].append(dist[i])
-#for j in range(CLUSTERS): print(f"{j}: {cluster[j]} {cdist[j]}")
-
-# ordered indexes of images in clusters
-ordered = [None]*CLUSTERS
-for j in range(CLUSTERS):
-  ordered[j] = [x for _,x in sorted(zip(cdist[j],cluster[j]))]
-# for j in range(CLUSTERS): print(f"{j}: {ordered[j]} {cdist[j]}")
+# images sorted by cluster and then by the distance from the center
+order = np.lexsort((dist,idx))
+counts = np.bincount(idx,minlength=CLUSTERS)		# no. of images in clusters
+starts = np.concatenate(([0],np.cumsum(counts)))	# cluster starts in the order
+
+# ordered indexes of images in clusters (views of the order)
+ordered = [order[starts[j]:starts[j+1]] for j in range(CLUSTERS)]
 
 # obtain maximum distance from the cluster center
-maxdist = 0
-for i in range(IMAGES):
-  if dist[i] > maxdist: maxdist = dist[i]
-
-# compute percentage distances from the center for every image
-pdist = [None]*IMAGES
-for j in range(CLUSTERS):
-  if ordered[j] == []: continue	# skip empty clusters
-  d0 = dist[ordered[j][0]]		# distance of the closest image to the center
-  for i in range(len(ordered[j])):
-    k = ordered[j][i]
-    pdist[k] = (maxdist-dist[k])/(maxdist-d0)*100
-
-# compute active number of images in cluster (above thresholds)
-above = [np.inf]*CLUSTERS
+maxdist = dist.max()
+
+# compute percentage distances from the center for every image, relative to the
+# distance of the closest image to the center
+d0 = np.zeros(CLUSTERS,dtype=np.float32)
+d0[counts>0] = dist[order[starts[:-1][counts>0]]]
+with np.errstate(divide="ignore",invalid="ignore"):
+  pdist = (maxdist-dist)/(maxdist-d0[idx])*100
+pdist[~np.isfinite(pdist)] = 100
+
+# compute active number of images in cluster (above thresholds): the position of
+# the first image beyond the threshold in every cluster
+above = np.full(CLUSTERS,np.inf)
 distthr = 0
 percthr = 0
-for j in range(CLUSTERS):
-  if ordered[j] == []: continue
-  for i in range(len(ordered[j])):
-    k = ordered[j][i]
-    if args.distthr and dist[k]>args.distthr:
-      if i<above[j]:
-        above[j] = i
-        distthr += 1
-    if args.percthr and pdist[k]<args.percthr:
-      if i<above[j]:
-        above[j] = i
-        percthr += 1
+if args.distthr or args.percthr:
+  pos = np.arange(IMAGES) - starts[idx[order]]	# positions in clusters
+  viold = dist[order] > args.distthr if args.distthr else np.zeros(IMAGES,dtype=bool)
+  violp = pdist[order] < args.percthr if args.percthr else np.zeros(IMAGES,dtype=bool)
+  viol = viold | violp
+  vclust,first = np.unique(idx[order][viol],return_index=True)
+  above[vclust] = pos[viol][first]
+  distthr = np.count_nonzero(viold[viol][first])
+  percthr = len(first) - distthr
 
 if args.distthr:
   MSG1("distance threshold")
@@ -476,47 +706,73 @@ if args.percthr:
   MSG1("perc threshold")
   MSG3(f"{percthr} images below {args.percthr}%")
 
+prof_stop("organize",images=IMAGES)
+
 # ---------------------------------------------------------------------- sort clusters
 
 # cindex = cluster indexes as sorted according to the number of elements
 cindex = list(range(CLUSTERS))
 
-# sort clusters according their size
+# sort clusters according their size (bigger first)
 if SORT == "size":
-  elements = [len(x) for x in cluster]
-  indexes  = list(range(CLUSTERS))
-  cindex = [x for _,x in sorted(zip(elements,indexes),reverse=True)]
+  cindex = list(np.lexsort((np.arange(CLUSTERS),counts))[::-1])
 
-# sort clusters by tsp
+# sort clusters by tsp, over the closest images to cluster centers (or centroids)
 if SORT == "tsp":
-  from sklearn.metrics import pairwise_distances
-  from python_tsp.distances import euclidean_distance_matrix
-  from python_tsp.exact import solve_tsp_dynamic_programming
-  from python_tsp.heuristics import solve_tsp_local_search, solve_tsp_simulated_annealing
-  TSP = []
-  TSP.append([]) 
-  vectors2 = []
-  #print(f"vectors:{len(vectors)}, ordered:{len(ordered)} clusters{CLUSTERS}")
+  MSG1(f"{SORT}"); T1=vtime(); prof_start("tsp")
+  vectors2 = np.empty((CLUSTERS,vectors.shape[1]),dtype=np.float32)
   for j in range(CLUSTERS):
-    #print(f"{j}-{ordered[j][0]}",end=" ")
-    #print(f"{j}",end=" ")
-    vectors2.append(vectors[ordered[j][0]])
-  #print("")
-
-  MSG1("distance matrix"); T1=vtime()
-  mdist = euclidean_distance_matrix(vectors2)
-  MSG3(f"{len(vectors2)}x{len(vectors2)} in {minsec(vtime()-T1)}")
-
-  MSG1(f"{SORT}"); T1=vtime()
-  permutation,distance = solve_tsp_simulated_annealing(mdist) 
-  MSG3(f"{minsec(vtime()-T1)}")
+    if not len(ordered[j]): vectors2[j] = clust.cluster_centers_[j]	# empty cluster
+    elif args.centroids:    vectors2[j] = vectors[ordered[j]].mean(0)
+    else:		    vectors2[j] = vectors[ordered[j][0]]
+  permutation,distance = tsp_order(vectors2,TSPTIME,args.seed)
+  MSG2(f"{CLUSTERS} {'centroids' if args.centroids else 'centers'}")
+  MSG3(f"length {distance:.1f} in {minsec(vtime()-T1)}")
 
   cindex = permutation
+  prof_stop("tsp",clusters=CLUSTERS,length=distance)
+
+# ------------------------------------------------------------- sort images in clusters
+
+# accepted images of the cluster (above thresholds) are reordered, rejected stay at
+# the end in the distance order
+def csorted(j,o):
+  n = int(min(len(o),above[j]))
+  return np.concatenate((o[:n],ordered[j][n:]))
+
+# tsp order of accepted images of the cluster, from the closest image to the center
+def csort_tsp(j,budget):
+  n = int(min(len(ordered[j]),above[j]))
+  path,_ = tsp_order(vectors[ordered[j][:n]],budget,args.seed,start=0)
+  return j,csorted(j,ordered[j][:n][path])
+
+# no sorting: accepted images in the loading order
+if CSORT == "none":
+  for j in range(CLUSTERS): ordered[j] = csorted(j,np.sort(ordered[j][:int(min(len(ordered[j]),above[j]))]))
+
+# tsp: clusters are sorted in parallel processes (biggest first), each one within
+# its share of the time budget, clusters over CSORTMAX are left in the dist order
+if CSORT == "tsp":
+  MSG1(f"csort {CSORT}"); T1=vtime(); prof_start("csort")
+  size = np.minimum(counts,above).astype(np.int64)
+  todo = [j for j in np.argsort(-size,kind="stable") if 3 < size[j] <= CSORTMAX]
+  big = np.count_nonzero(size > CSORTMAX)
+  budget = TSPTIME * min(THREADS,len(todo)) / max(1,len(todo))
+  if len(todo) > 1 and THREADS > 1:
+    from multiprocessing import Pool
+    with Pool(min(THREADS,len(todo))) as pool:
+      for j,o in pool.starmap(csort_tsp,[(j,budget) for j in todo]): ordered[j] = o
+  else:
+    for j in todo: ordered[j] = csort_tsp(j,budget)[1]
+  MSG2(f"{len(todo)} clusters")
+  if big: MSG2(f"({big} over {CSORTMAX} by dist)")
+  MSG3(f"in {minsec(vtime()-T1)}")
+  prof_stop("csort",images=int(size[todo].sum()),clusters=len(todo))
 
 # TODO: listing only if requested
 if 0:
   print("  i: ID  N")
-  for j in range(CLUSTERS): print(f"{j+1:3}: {cindex[j]:<3} {elements[cindex[j]]:<3}")
+  for j in range(CLUSTERS): print(f"{j+1:3}: {cindex[j]:<3} {counts[cindex[j]]:<3}")
 
 # ------------------------------------------------ copy images according their cluster
 
@@ -530,45 +786,44 @@ if 0:
 # from web import *
 # include "web.py"
 
-# distribute all images into per-cluster html sections
-section = [""]*CLUSTERS
-for jj in range(CLUSTERS):		# j = cluster index as from kmeans
-  j = cindex[jj]
-  for i in range(len(ordered[j])):	# i = order in_the_cluster
-    k = ordered[j][i]			# k = image_index
-    bad = 1 if i>=above[j] else 0;
-    if not args.html: # csv output
-      section[j] += f"{paths[k]} {jj+1} {dist[k]:.1f} {pdist[k]:.1f} {bad}\n"
-    else: # html output
-      section[j] += addimg(f"{paths[k]}",f"cluster{jj+1}",f"{pdist[k]:.0f}% {dist[k]:.0f}cm",bad)
-
-MSG1("write output")
+MSG1("write output"); prof_start("output")
 output = outputname()
+WBUF = 1<<20 # write buffer size
 
-# save csv
-BODY = ""
+# save csv, streamed cluster by cluster
 if not args.html:
   output = f"{output}.csv"
-  for i in range(CLUSTERS):
-    BODY += section[cindex[i]]
-  with open(output,"w") as fd:
+  with open(output,"w",buffering=WBUF) as fd:
     fd.write("#path cluster dist pdist bad\n")
-    fd.write(BODY)
+    for jj in range(CLUSTERS):		# j = cluster index as from kmeans
+      j = cindex[jj]
+      fd.writelines(f"{paths[k]} {jj+1} {dist[k]:.1f} {pdist[k]:.1f} {1 if i>=above[j] else 0}\n" for i,k in enumerate(ordered[j]))
+  model_save(output,float(dist.mean()))
 
-# save html
+# save html, streamed into pages of HTMLPAGE clusters
 else:
-  output = f"{output}.html"
-  for i in range(CLUSTERS):
-    BODY += f"<h2>cluster {i+1}</h2>\n"
-    BODY += section[cindex[i]]
-    BODY += "\n\n"
-  html = HTML.format(BODY=BODY,CSS=CSS)
-  with open(output,"w") as fd:
-    fd.write(html)
+  pages = -(-CLUSTERS//HTMLPAGE)
+  for page in range(pages):
+    with open(htmlpage(output,page),"w",buffering=WBUF) as fd:
+      fd.write(HTMLHEAD)
+      fd.write(htmlnav(output,page,pages))
+      for jj in range(page*HTMLPAGE,min(CLUSTERS,(page+1)*HTMLPAGE)):
+        j = cindex[jj]
+        fd.write(f"<h2>cluster {jj+1}</h2>\n")
+        fd.writelines(addimg(f"{paths[k]}",f"cluster{jj+1}",f"{pdist[k]:.0f}% {dist[k]:.0f}cm",i>=above[j]) for i,k in enumerate(ordered[j]))
+        fd.write("\n\n")
+      fd.write(htmlnav(output,page,pages))
+      fd.write(HTMLTAIL)
+  output = htmlpage(output,0)
+  if pages>1: MSG2(f"{pages} pages,")
 
 MSG3(output)
+prof_stop("output",images=IMAGES)
 # ------------------------------------------------------------------------------------
 # include "metric.py"
+prof_start("metric")
 metric()
+prof_stop("metric",images=IMAGES)
+if VERBOSE: MSGimports()
 
 # ------------------------------------------------------------------------------------
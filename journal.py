@@ -0,0 +1,142 @@
+import pickle,shutil
+from multiprocessing import Pool,current_process
+
+# ------------------------------------------------------------------------------------
+# run journal (-jr): the run is checkpointed into the .journal dir next to the output,
+# and started again with the same arguments it resumes at the first unfinished stage:
+#   vectors.raw - loaded (reduced) vectors, appended batch by batch, in VDTYPE
+#   rows.lst    - paths of these vectors, a line per row
+#   NAME.pkl    - items: the trained reducer, finished clustering attempts (and sweep
+#                 values), the clustering itself
+#   journal     - the log: arguments, then "rows N" after every batch and "item NAME"
+#                 after every item, only what the log lists is valid
+# new rows invalidate the items after the load (attempts, clustering)
+
+JOURNAL = None # the journal of the run (None if not journaled)
+
+# the log line (and fsync, so that the log never gets ahead of the data)
+def journal_log(line):
+  with open(f"{JOURNAL.dir}/journal","a") as fd:
+    fd.write(f"{line}\n")
+    fd.flush()
+    os.fsync(fd.fileno())
+
+# open the journal of the run, or start a new one if arguments or images differ
+def journal_init(paths):
+  global JOURNAL
+  if not args.journal or AMODEL: return
+  jr = types.SimpleNamespace()
+  jr.dir = f"{outputname()}.journal"
+  jr.args = " ".join(a for a in sys.argv[1:] if a != "-v")
+  jr.rows = []		# paths of journaled rows
+  jr.items = set()	# names of journaled items
+  jr.resumed = 0	# no. of rows from the previous run
+  jr.new = 0		# whether rows were added in this run
+  JOURNAL = jr
+
+  # read the log
+  n,ok = 0,0
+  if os.path.exists(f"{jr.dir}/journal"):
+    with open(f"{jr.dir}/journal") as fd:
+      ok = fd.readline().rstrip("\n") == f"#args {jr.args}"
+      for line in fd:
+        if line[-1:] != "\n": break	# interrupted write
+        what,value = line.rstrip("\n").split(" ",1)
+        if   what == "rows": n = int(value)
+        elif what == "item": jr.items.add(value)
+        elif what == "reset": jr.items &= {"reducer"}
+  if ok and n:
+    with open(f"{jr.dir}/rows.lst") as fd: jr.rows = fd.read().split("\n")[:n]
+    ok = len(jr.rows) == n and set(jr.rows) <= set(paths)
+
+  # new journal
+  if not ok:
+    if os.path.exists(jr.dir):
+      MSG("journal",f"arguments or images differ, new journal {jr.dir}")
+      shutil.rmtree(jr.dir)
+    os.makedirs(jr.dir)
+    jr.rows,jr.items = [],set()
+    with open(f"{jr.dir}/journal","w") as fd: fd.write(f"#args {jr.args}\n")
+    return
+  jr.resumed = len(jr.rows)
+  items = {}
+  for name in jr.items: items[name.split(".")[0]] = items.get(name.split(".")[0],0) + 1
+  MSG1("journal")
+  MSG2(f"resume {len(jr.rows)} rows,")
+  for name,count in sorted(items.items()): MSG2(f"{count} {name}s," if count > 1 else f"{name},")
+  MSG3(f"from {jr.dir}")
+
+# drop journaled rows from the cache lists to load, into the cache.done list
+def journal_skip(cache):
+  cache.done = list(JOURNAL.rows[:JOURNAL.resumed]) if JOURNAL else []
+  if not cache.done: return
+  done = set(cache.done)
+  cache.paths2 = [p for p in cache.paths2 if not p in done]
+  cache.paths1 = [p for p in cache.paths1 if not p in done]
+  cache.paths0 = [p for p in cache.paths0 if not p in done]
+
+# fill the start of the vectors array by journaled rows, return their number
+def journal_fill(vectors):
+  if not JOURNAL or not JOURNAL.resumed: return 0
+  n,dim = JOURNAL.resumed,vectors.shape[1]
+  file = f"{JOURNAL.dir}/vectors.raw"
+  if os.path.getsize(file) < n*dim*vectors.itemsize: MSGE(f"journal {file} is shorter than its log")
+  saved = np.memmap(file,dtype=vectors.dtype,mode="r",shape=(n,dim))
+  for i in range(0,n,BATCHSIZE): vectors[i:i+BATCHSIZE] = saved[i:i+BATCHSIZE]
+  return n
+
+# append the batch of loaded vectors with their paths
+def journal_batch(paths,vectors):
+  if not JOURNAL: return
+  jr = JOURNAL
+  if not jr.new:
+    # cut the tails written after the last logged batch, and invalidate later items
+    size = len(jr.rows)*vectors.shape[1]*vectors.itemsize
+    if os.path.exists(f"{jr.dir}/vectors.raw"): os.truncate(f"{jr.dir}/vectors.raw",size)
+    with open(f"{jr.dir}/rows.lst","w") as fd: fd.writelines(f"{p}\n" for p in jr.rows)
+    if jr.items - {"reducer"}: journal_log("reset")
+    jr.items &= {"reducer"}
+    jr.new = 1
+  with open(f"{jr.dir}/vectors.raw","ab") as fd: np.asarray(vectors,dtype=VDTYPE).tofile(fd)
+  with open(f"{jr.dir}/rows.lst","a") as fd: fd.writelines(f"{p}\n" for p in paths)
+  jr.rows += paths
+  journal_log(f"rows {len(jr.rows)}")
+
+# journaled item, or None
+def journal_get(name):
+  if not JOURNAL or not name in JOURNAL.items: return None
+  with open(f"{JOURNAL.dir}/{name}.pkl","rb") as fd: return pickle.load(fd)
+
+# save the item into the journal
+def journal_put(name,item):
+  if not JOURNAL: return
+  file = f"{JOURNAL.dir}/{name}.pkl"
+  with open(f"{file}.tmp","wb") as fd: pickle.dump(item,fd)
+  os.replace(f"{file}.tmp",file)
+  JOURNAL.items.add(name)
+  journal_log(f"item {name}")
+
+# single job of the journal_map (worker)
+def journal_job(a):
+  fn,i,job = a
+  return i,fn(*job)
+
+# results of fn over the jobs (in procs processes), the jobs finished by the previous
+# run are taken from the journal, others are saved into it as they finish (if name)
+def journal_map(name,fn,jobs,procs=1):
+  done = {}
+  if name:
+    for i in range(len(jobs)):
+      r = journal_get(f"{name}.{i}")
+      if r is not None: done[i] = r
+    if done: MSG2(f"({len(done)} of {len(jobs)} from the journal)")
+  todo = [i for i in range(len(jobs)) if not i in done]
+  def finished(i,r):
+    done[i] = r
+    if name: journal_put(f"{name}.{i}",r)
+  if procs > 1 and len(todo) > 1 and not current_process().daemon:
+    with Pool(min(procs,len(todo))) as pool:
+      for i,r in pool.imap_unordered(journal_job,[(fn,i,jobs[i]) for i in todo]): finished(i,r)
+  else:
+    for i in todo: finished(i,fn(*jobs[i]))
+  return [done[i] for i in range(len(jobs))]
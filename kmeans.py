@@ -0,0 +1,104 @@
+from multiprocessing import current_process
+
+# ------------------------------------------------------------------------------------
+# native mini-batch k-means: k-means++ seeding on a sample, then mini-batches of
+# contiguous rows streamed from the (possibly memory-mapped) matrix, float32 all the
+# way; restarts run in parallel processes and the best one is chosen by the inertia
+# on the sample, so that only the final assignment passes over all vectors
+
+MKMBATCH = 4096 # rows per mini-batch
+MKMEPOCHS = 10 # max. passes over the data
+MKMSAMPLE = 32768 # sample for the seeding and for comparing restarts
+MKMTOL = 1e-4 # stop when centers move less (relative to the variance of the data)
+MKMX = None # the data matrix, shared with restart processes by fork
+
+# squared distances of rows to centers, c2 are squared norms of centers
+def mkm_dist(X,C,c2):
+  d = np.einsum("ij,ij->i",X,X)[:,None] + c2[None,:] - 2*(X@C.T)
+  return np.maximum(d,0,out=d)
+
+# random sample of rows (sorted, for the locality of memory-mapped reads)
+def mkm_sample(X,n,rng):
+  if len(X) <= n: return np.asarray(X,dtype=np.float32)
+  return np.asarray(X[np.sort(rng.choice(len(X),n,replace=False))],dtype=np.float32)
+
+# greedy k-means++ seeding from the sample S: of 2+log(k) candidates drawn by the
+# k-means++ probabilities, the one reducing the potential most is taken
+def mkm_seed(S,k,rng):
+  C = np.empty((k,S.shape[1]),dtype=np.float32)
+  trials = 2 + int(np.log(k))
+  C[0] = S[rng.integers(len(S))]
+  d = mkm_dist(S,C[:1],np.einsum("ij,ij->i",C[:1],C[:1]))[:,0]
+  for i in range(1,k):
+    total = d.sum()
+    cand = S[rng.choice(len(S),trials,p=d/total) if total > 0 else rng.integers(len(S),size=trials)]
+    dc = np.minimum(d[:,None],mkm_dist(S,cand,np.einsum("ij,ij->i",cand,cand)))
+    best = int(np.argmin(dc.sum(0)))
+    C[i] = cand[best]
+    d = dc[:,best]
+  return C
+
+# single run from the seed (worker): return centers, inertia estimated on the sample,
+# and number of epochs
+def mkm_run(k,seed,init=None,threads=None):
+  from threadpoolctl import threadpool_limits
+  with threadpool_limits(threads):
+    X = MKMX
+    n = len(X)
+    rng = np.random.default_rng(seed)
+    S = mkm_sample(X,MKMSAMPLE,rng)
+    C = np.array(init,dtype=np.float32) if init is not None else mkm_seed(S,k,rng)
+    counts = np.zeros(k,dtype=np.float64) # no. of rows seen per center
+    B = min(MKMBATCH,n)
+    scale = float(np.var(S,0).sum()) or 1
+
+    for epoch in range(MKMEPOCHS):
+      C0 = C.copy()
+      for s in rng.permutation(np.arange(0,n,B)):
+        Xb = np.asarray(X[s:s+B],dtype=np.float32)
+        lb = np.argmin(mkm_dist(Xb,C,np.einsum("ij,ij->i",C,C)),1)
+        nb = np.bincount(lb,minlength=k)
+        nz = nb > 0
+        sums = np.add.reduceat(Xb[np.argsort(lb,kind="stable")],(np.cumsum(nb)-nb)[nz],axis=0)
+        counts[nz] += nb[nz]
+        eta = (nb[nz]/counts[nz]).astype(np.float32)[:,None] # per-center learning rate
+        C[nz] += eta * (sums/nb[nz][:,None] - C[nz])
+
+      # relocate centers which got no rows to random rows of the sample
+      empty = np.flatnonzero(counts == 0)
+      if len(empty): C[empty] = S[rng.choice(len(S),len(empty),replace=False)]
+      if not len(empty) and ((C-C0)**2).sum(1).max() < MKMTOL*scale: break
+
+    d = mkm_dist(S,C,np.einsum("ij,ij->i",C,C)).min(1)
+    return C,float(d.sum())*n/len(S),epoch+1
+
+# assign all rows to the nearest centers by mini-batches, return labels and inertia
+def mkm_assign(X,C):
+  labels = np.empty(len(X),dtype=np.int32)
+  inertia = 0.0
+  c2 = np.einsum("ij,ij->i",C,C)
+  for i in range(0,len(X),MKMBATCH):
+    d = mkm_dist(np.asarray(X[i:i+MKMBATCH],dtype=np.float32),C,c2)
+    labels[i:i+MKMBATCH] = np.argmin(d,1)
+    inertia += float(d[np.arange(len(d)),labels[i:i+MKMBATCH]].sum())
+  return labels,inertia
+
+# fit the engine to X, restarts in parallel (serially if already in a worker process)
+def mkm_fit(clust,X):
+  global MKMX
+  MKMX = X
+  seeds = np.random.default_rng(clust.random_state).integers(1<<31,size=clust.n_init)
+  procs = min(THREADS,clust.n_init) if not current_process().daemon else 1
+  runs = journal_map(getattr(clust,"journal",None),mkm_run,[(clust.n_clusters,s,clust.init,1 if procs > 1 else None) for s in seeds],procs)
+  C,_,clust.n_iter_ = min(runs,key=lambda r: r[1])
+  clust.labels_,clust.inertia_ = mkm_assign(X,C)
+  clust.cluster_centers_ = C
+  MKMX = None
+  return clust
+
+# the engine, with the sklearn-like interface used by imclust
+def mkm_engine(k,n_init,init=None,random_state=None,verbose=0):
+  clust = types.SimpleNamespace(n_clusters=k,n_init=n_init,init=init,random_state=random_state,verbose=verbose)
+  clust.fit = lambda X: mkm_fit(clust,X)
+  return clust
+
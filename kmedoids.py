@@ -0,0 +1,108 @@
+# ------------------------------------------------------------------------------------
+# native k-medoids: CLARA over FasterPAM, medoids are searched on samples of KMDSAMPLE
+# images (with the sample distance matrix only, computed in chunks), samples run in
+# parallel processes, and the medoids of the sample with the lowest total distance
+# over all images win (evaluated by streaming all vectors against the medoids)
+
+KMDSAMPLE = 4096 # images per sample (at least 40+2k)
+KMDPASSES = 10 # max. passes over candidates in FasterPAM
+
+# sample size for k medoids of n images, and the memory of its distance matrix
+def kmd_size(n,k):
+  m = min(n,max(KMDSAMPLE,40+2*k))
+  return m,4*m*m
+
+# the distance matrix of the sample, in chunks of rows
+def kmd_matrix(S):
+  s2 = np.einsum("ij,ij->i",S,S)
+  D = np.empty((len(S),len(S)),dtype=np.float32)
+  for i in range(0,len(S),1024):
+    D[i:i+1024] = np.sqrt(mkm_dist(S[i:i+1024],S,s2))
+  np.fill_diagonal(D,0)
+  return D
+
+# nearest and second nearest medoids of all points, and distances to them
+def kmd_near(D,med):
+  Dm = D[:,med]
+  two = np.argpartition(Dm,1,axis=1)[:,:2]
+  d2 = np.take_along_axis(Dm,two,1)
+  swap = d2[:,1] < d2[:,0]
+  two[swap] = two[swap][:,::-1]
+  d2[swap] = d2[swap][:,::-1]
+  return two[:,0],d2[:,0],d2[:,1]
+
+# FasterPAM on the distance matrix D: k-means++ like initialization, then eager
+# swaps of the first improving candidate, each evaluated for all medoids at once
+def kmd_pam(D,k,rng):
+  m = len(D)
+  med = np.empty(k,dtype=np.int64)
+  med[0] = rng.integers(m)
+  d = D[med[0]].astype(np.float64)
+  for i in range(1,k):
+    med[i] = rng.choice(m,p=d/d.sum()) if d.sum() > 0 else rng.integers(m)
+    d = np.minimum(d,D[med[i]])
+
+  near,dn,ds = kmd_near(D,med)
+  ismed = np.zeros(m,dtype=bool)
+  ismed[med] = True
+  tol = 1e-6 * max(float(dn.mean()),1e-12)
+  c,since,evals = 0,0,0
+  while since < m and evals < KMDPASSES*m:
+    if not ismed[c]:
+      dc = D[c]
+      shared = float(np.minimum(dc-dn,0).sum())			# points moving to c
+      loss = np.bincount(near,np.where(dc<dn,0,np.minimum(dc,ds)-dn),k)	# removal of medoids
+      i = int(np.argmin(loss))
+      if shared + loss[i] < -tol:
+        ismed[med[i]] = False
+        med[i] = c
+        ismed[c] = True
+        near,dn,ds = kmd_near(D,med)
+        since = 0
+      evals += 1
+    c = (c+1) % m
+    since += 1
+  return med
+
+# assign all rows to the nearest medoid vectors M, return labels and total distance
+def kmd_assign(X,M):
+  labels = np.empty(len(X),dtype=np.int32)
+  total = 0.0
+  m2 = np.einsum("ij,ij->i",M,M)
+  for i in range(0,len(X),MKMBATCH):
+    d = mkm_dist(np.asarray(X[i:i+MKMBATCH],dtype=np.float32),M,m2)
+    labels[i:i+MKMBATCH] = np.argmin(d,1)
+    total += float(np.sqrt(d[np.arange(len(d)),labels[i:i+MKMBATCH]]).sum())
+  return labels,total
+
+# single CLARA sample (worker): return global medoid indexes and their total distance
+def kmd_run(k,seed,threads=None):
+  from threadpoolctl import threadpool_limits
+  with threadpool_limits(threads):
+    X = MKMX
+    rng = np.random.default_rng(seed)
+    m,_ = kmd_size(len(X),k)
+    rows = np.sort(rng.choice(len(X),m,replace=False)) if m < len(X) else np.arange(len(X))
+    med = rows[kmd_pam(kmd_matrix(np.asarray(X[rows],dtype=np.float32)),k,rng)]
+    return med,kmd_assign(X,np.asarray(X[np.sort(med)],dtype=np.float32))[1]
+
+# fit the engine to X, samples in parallel (serially if already in a worker process)
+def kmd_fit(clust,X):
+  global MKMX
+  MKMX = X
+  seeds = np.random.default_rng(clust.random_state).integers(1<<31,size=clust.n_init)
+  procs = min(THREADS,clust.n_init) if not current_process().daemon else 1
+  runs = journal_map(getattr(clust,"journal",None),kmd_run,[(clust.n_clusters,s,1 if procs > 1 else None) for s in seeds],procs)
+  med,_ = min(runs,key=lambda r: r[1])
+  clust.medoid_indices_ = np.sort(med)
+  clust.cluster_centers_ = np.asarray(X[clust.medoid_indices_],dtype=np.float32)
+  clust.labels_,clust.inertia_ = kmd_assign(X,clust.cluster_centers_)
+  MKMX = None
+  return clust
+
+# the engine, with the sklearn-like interface used by imclust
+def kmd_engine(k,n_init,random_state=None,verbose=0):
+  clust = types.SimpleNamespace(n_clusters=k,n_init=n_init,random_state=random_state,verbose=verbose)
+  clust.fit = lambda X: kmd_fit(clust,X)
+  return clust
+
@@ -1,4 +1,12 @@
 # include "loadresize.py"
+# include "pipeline.py"
+import tempfile
+
+# preallocate the output array of vectors, in RAM or memory-mapped to a temporary file
+def valloc(rows,cols,dtype=np.float32):
+  if not args.mmap: return np.empty([rows,cols],dtype=dtype)
+  dir = args.cachedir if args.cachedir!="" else None
+  return np.memmap(tempfile.TemporaryFile(dir=dir),dtype=dtype,mode="w+",shape=(rows,cols))
 
 # the input loop: load + resize + nn + redim
 def data_load(cache,prcpt,redim):
@@ -15,23 +23,30 @@ def data_load(cache,prcpt,redim):
 
   # loading itself
   MSG1("load"); T1 = vtime()
-  all_vectors = np.empty([0,redim.size],dtype=np.float32)
-  images  = []	# 
+  rows = len(cache.done) + len(cache.paths2) + len(cache.paths1) + len(cache.paths0)
+  all_vectors = valloc(rows,redim.size,VDTYPE)
+  k = journal_fill(all_vectors)	# output row index, after rows of the journaled run
+  nimages = 0	# number of loaded images
   cached1 = []	# newly-cached list for perception vectors
   cached2 = []	# newly-cached list for dim-reduced vectors
   ibytes = 0	# accumulated hypothetical space needed for images
   j = 0		# batch index
-  
+  times = stimes()
+  writer = writer_init(cache,times)
+
   # 1st: cached already reduced dimensions -> just load
   i = 0 # image index
   end = len(cache.paths2)
   while i < end:
     i2 = i + BATCHSIZE
     if i2 > end: i2 = end
-    MSGC("C")
-    vectors = loadraws(cache.paths2[i:i2],cache.sx2,cache.cdir)
-    MSGP(j)
-    all_vectors = np.concatenate((all_vectors,vectors),0)
+    MSGC("C"); T = vtime()
+    vectors = cload(cache,cache.paths2[i:i2],cache.sx2)
+    times["cache load"] += vtime()-T
+    MSGP(j); prof_batch("load",j,len(vectors),"C")
+    all_vectors[k:k+len(vectors)] = vectors
+    journal_batch(cache.paths2[i:i2],all_vectors[k:k+len(vectors)])
+    k += len(vectors)
     i += len(vectors)
     j += 1
 
@@ -41,55 +56,69 @@ def data_load(cache,prcpt,redim):
   while i < end:
     i2 = i + BATCHSIZE
     if i2 > end: i2 = end
-    MSGC("c")
-    vectors = loadraws(cache.paths1[i:i2],cache.sx1s,cache.cdir)
-    MSGC("\br")
+    MSGC("c"); T = vtime()
+    vectors = cload(cache,cache.paths1[i:i2],cache.sx1s)
+    MSGC("\br"); T2 = vtime()
     vectors = reduce(redim,vectors)
+    times["cache load"] += T2-T; times["reduce"] += vtime()-T2
     if args.cache:
-      saveraws(cache.paths1[i:i2],cache.sx2,cache.cdir,vectors)
+      writer_put(writer,cache.paths1[i:i2],cache.sx2,vectors)
       cached2 += cache.paths1[i:i2]
-    MSGP(j)
-    all_vectors = np.concatenate((all_vectors,vectors),0)
+    MSGP(j); prof_batch("load",j,len(vectors),"c")
+    all_vectors[k:k+len(vectors)] = vectors
+    journal_batch(cache.paths1[i:i2],all_vectors[k:k+len(vectors)])
+    k += len(vectors)
     i += len(vectors)
     j += 1
 
-  # 3rd: raw images -> load, resize, nn infer, reduce dim.
-  i = 0
-  end = len(cache.paths0)
-  while i < end:
-    i2 = i + BATCHSIZE
-    if i2 > end: i2 = end
-    MSGC("l")
-    images = loadresize(cache.paths0[i:i2],prcpt.isize)
+  # 3rd: raw images -> load, resize, nn infer, reduce dim. (loading runs ahead)
+  bad = [] # malformed images
+  for batch,images in prefetch(cache.paths0,prcpt.isize,times,bad):
+    nimages += len(images)
     ibytes += images.nbytes
-    MSGC("\bn")
+    MSGC("n"); T = vtime()
     vectors = perceive(prcpt,images)
+    times["perceive"] += vtime()-T
     if args.cache:
-      saveraws(cache.paths0[i:i2],cache.sx1,cache.cdir,vectors)
-      cached1 += cache.paths0[i:i2]
-    MSGC("\br")
+      writer_put(writer,batch,cache.sx1,vectors)
+      cached1 += batch
+    MSGC("\br"); T = vtime()
     vectors = reduce(redim,vectors)
+    times["reduce"] += vtime()-T
     if args.cache:
-      saveraws(cache.paths0[i:i2],cache.sx2,cache.cdir,vectors)
-      cached2 += cache.paths0[i:i2]
-    MSGP(j)
-    all_vectors = np.concatenate((all_vectors,vectors),0)
-    i += len(vectors)
+      writer_put(writer,batch,cache.sx2,vectors)
+      cached2 += batch
+    MSGP(j); prof_batch("load",j,len(vectors),"n")
+    all_vectors[k:k+len(vectors)] = vectors
+    journal_batch(batch,all_vectors[k:k+len(vectors)])
+    k += len(vectors)
     j += 1
+  writer_end(writer)
+
+  # drop malformed images, to keep paths aligned with vectors
+  if bad:
+    cache_drop(cache,bad)
+    all_vectors = all_vectors[:k]
 
   # end
   T2 = vtime()
 
   MSG2("")
-  if len(images): MSG2(f"{metric(ibytes)}B of {len(images)} images,")
+  if nimages: MSG2(f"{metric(ibytes)}B of {nimages} images,")
   MSG2(f"{metric(all_vectors.nbytes)}B of {len(all_vectors)} vectors")
-  MSG3(f"in {j} batches in {minsec(T2-T1)}")
+  if cache.done: MSG2(f"({len(cache.done)} from the journal)")
+  MSG2(f"in {j} batches in {minsec(T2-T1)},")
+  MSG3(f"{metric(peakram())}B peak RAM")
+  MSGstimes(times)
+  prof_note("load",times={k:round(v,4) for k,v in times.items()},batches=j,pictures=nimages,
+    cached=len(cached1)+len(cached2),bad=len(bad))
 
   if cached1 or cached2:  MSG1("newly cached")
   if cached1:		  MSG2(f"{len(cached1)} percept. vectors")
   if cached1 and cached2: MSG2("and")
   if cached2:		  MSG2(f"{len(cached2)} reduced vectors")
   if cached1 or cached2:  MSG3("")
+  MSGbad(bad)
 
   return all_vectors
 
@@ -1,30 +1,87 @@
-from multiprocessing.pool import ThreadPool
-from imageio import imread
-from skimage.transform import resize
+import tempfile
+from multiprocessing.pool import ThreadPool,Pool
 
-# function to load and resize images
-def lrworker(path,size):
+LRPOOL = None # persistent loading pool (threads, or processes)
+LRIMPORTED = 0 # whether the loader modules are imported
+
+# import the loader modules lazily (skimage is slow to import)
+def lrimport():
+  global LRIMPORTED,imread,resize,Image
+  if LRIMPORTED: return
+  if LOADER == "pil": Image = timport("PIL.Image")
+  else:
+    imread = timport("imageio").imread
+    resize = timport("skimage.transform").resize
+  LRIMPORTED = 1
+
+# return the loading pool, create it on the first call
+def lrpool():
+  global LRPOOL
+  if LRPOOL is None: LRPOOL = Pool(THREADS) if args.procs else ThreadPool(THREADS)
+  return LRPOOL
+
+# normalize the image to c channels: gray -> rgb, rgba -> rgb, 1st frame of animations
+def lrchannels(image,c):
+  if image.ndim == 4: image = image[0]
+  if image.ndim == 2: image = image[:,:,None]
+  if image.shape[2] > c: image = image[:,:,:c]
+  if image.shape[2] < c: image = np.repeat(image[:,:,:1],c,axis=2)
+  return image
+
+# imageio + skimage loader, float image 0..1
+def lrski(path,size):
+  image = lrchannels(imread(str(path)),size[2])
+  return resize(image,size,anti_aliasing=True)
+
+# PIL loader, uint8 image, jpegs are decoded directly in reduced resolution (draft)
+def lrpil(path,size):
+  with Image.open(path) as image:
+    image.draft("RGB",(size[1],size[0]))	# scale-on-decode, to at least the size
+    image = image.convert("RGB").resize((size[1],size[0]),Image.BILINEAR)
+  return np.asarray(image)
+
+# function to load and resize image into the i-th row of the batch array, the out is
+# the array itself (threads), or (file,shape,dtype) of the shared-memory file (processes)
+def lrworker(path,size,i,out):
   # print(f"---> {path}")
   # image = cv2.imread(path)
   # image = cv2.resize(image,size)
   # cv2.imwrite("/tmp/cv2.png",image)
+  lrimport() # in process workers forked before the import
+  if isinstance(out,tuple): out = np.memmap(out[0],dtype=out[2],mode="r+",shape=out[1])
   try:
-    image = imread(str(path))
+    out[i] = lrpil(path,size) if LOADER == "pil" else lrski(path,size)
   except:
     print(f"\nmalformed image: {path}\n")
-    return
-  image = resize(image,size,anti_aliasing=True)
-  return image
+    out[i] = 0
+    return 0
+  return 1
 
-# load and resize images in a thread pool
+# load and resize images in the pool straight into the preallocated batch-array,
+# return the batch of good images and the list of malformed ones (dropped from batch)
 def loadresize(paths,size):
-  images = np.empty([0,size[0],size[1],size[2]],dtype=np.float32)
-  pool = ThreadPool(THREADS)
-  results = []
-  for path in paths:
-    results.append(pool.apply_async(lrworker,args=(path,size)))
-  pool.close()
-  pool.join()
-  images = np.array([r.get() for r in results]) # assemble the batch-array
-  return images
+  dtype = np.uint8 if LOADER == "pil" else np.float32
+  shape = (len(paths),size[0],size[1],size[2])
+  pool = lrpool()
+  lrimport()
+
+  # threads write directly into the batch
+  if not args.procs:
+    images = np.empty(shape,dtype=dtype)
+    ok = pool.starmap(lrworker,[(p,size,i,images) for i,p in enumerate(paths)])
+    return lrdrop(paths,images,ok)
+
+  # processes write into the file in shared memory
+  shm = "/dev/shm" if os.path.isdir("/dev/shm") else None
+  with tempfile.NamedTemporaryFile(dir=shm) as fd:
+    fd.truncate(max(1,int(np.prod(shape))*np.dtype(dtype).itemsize))
+    ok = pool.starmap(lrworker,[(p,size,i,(fd.name,shape,dtype)) for i,p in enumerate(paths)],chunksize=16)
+    images = np.array(np.memmap(fd.name,dtype=dtype,mode="r",shape=shape))
+  return lrdrop(paths,images,ok)
+
+# drop malformed images from the batch
+def lrdrop(paths,images,ok):
+  if all(ok): return images,[]
+  ok = np.array(ok,dtype=bool)
+  return images[ok],[p for p,o in zip(paths,ok) if not o]
 
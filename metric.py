@@ -1,30 +1,163 @@
 # CHS higher=better
 # MSC higher=better
 # DBS  lower=better
+# COP  lower=better
 # SDbw lower=better
 
-def metric():
-  if args.nometric == 1: return
-  
-  MSG1("metric")
-  from sklearn import metrics
-  CHS = metrics.calinski_harabasz_score(vectors,idx)
-  MSG2(f"CHS^={CHS:.2f}")
+# ------------------------------------------------------------------------------------
+# silhouette and COP without the NxN distance matrix: distances of rows (all images,
+# or the stratified sample of them) to all images are computed by chunks of METRICMEM
+# bytes, and reduced per cluster right away; for the sample, the silhouette comes with
+# the 95% confidence interval, and the COP uses the farthest images of every cluster
+# (which define its max. linkage to other clusters) on top of the random ones
 
-  MSC = metrics.silhouette_score(vectors,idx)
-  MSG2(f"MSC^={MSC:.3f}")
+METRICN = 10000 # images in the metric sample (all if less), 0 = all
+METRICMEM = 1<<28 # bytes per chunk of distances
 
-  DBS = metrics.davies_bouldin_score(vectors,idx)
-  MSG2(f"DBS={DBS:.3f}")
+# stratified sample: random images proportionally from every cluster (for silhouette),
+# plus the farthest ones from the center (for COP), return (random,farthest) indexes
+def msample(n):
+  rng = np.random.default_rng(args.seed)
+  rand,far = [],[]
+  for j in range(CLUSTERS):
+    o = order[starts[j]:starts[j+1]] # by the distance from the center
+    if not len(o): continue
+    m = min(len(o),max(1,round(n*len(o)/IMAGES)))
+    rand.append(rng.choice(o,m,replace=False))
+    far.append(o[-(-m//4):])
+  return np.concatenate(rand),np.concatenate(far)
+
+# distances of the rows to all images, columns sorted by clusters, reduced per cluster
+# into sums and maxima, row by row in chunks: return (sums,maxs) of shape rows x CLUSTERS
+def mreduce(rows):
+  nz = np.flatnonzero(counts)
+  sq = np.empty(IMAGES,dtype=np.float32)
+  for i in range(0,IMAGES,BATCHSIZE): sq[i:i+BATCHSIZE] = np.einsum("ij,ij->i",vectors[i:i+BATCHSIZE],vectors[i:i+BATCHSIZE])
+  sums = np.zeros((len(rows),CLUSTERS),dtype=np.float64)
+  maxs = np.zeros((len(rows),CLUSTERS),dtype=np.float32)
+  inv = np.empty(IMAGES,dtype=np.int64) # positions of images in the order
+  inv[order] = np.arange(IMAGES)
+  step = max(1,METRICMEM//(4*IMAGES))
+  D = np.empty((min(step,len(rows)),IMAGES),dtype=np.float32)
+  for i in range(0,len(rows),step):
+    r = rows[i:i+step]
+    V = np.asarray(vectors[r],dtype=np.float32)
+    for k in range(0,IMAGES,BATCHSIZE): # vectors by batches (might be memory-mapped)
+      D[:len(r),k:k+BATCHSIZE] = sq[r,None] + sq[None,k:k+BATCHSIZE] - 2*(V@np.asarray(vectors[k:k+BATCHSIZE],dtype=np.float32).T)
+    D = np.sqrt(np.maximum(D,0,out=D),out=D)
+    Ds = D[:len(r),order]
+    Ds[np.arange(len(r)),inv[r]] = 0 # itself
+    sums[i:i+step,nz] = np.add.reduceat(Ds,starts[nz],axis=1)
+    maxs[i:i+step,nz] = np.maximum.reduceat(Ds,starts[nz],axis=1)
+  return sums,maxs
+
+# silhouette of rows from their per-cluster distance sums, 0 for singleton clusters
+def msilhouette(rows,sums):
+  c = idx[rows]
+  n = counts[c]
+  a = sums[np.arange(len(rows)),c] / np.maximum(n-1,1)
+  with np.errstate(divide="ignore",invalid="ignore"):
+    mean = sums / counts
+  mean[:,counts==0] = np.inf
+  mean[np.arange(len(rows)),c] = np.inf
+  b = mean.min(1)
+  with np.errstate(divide="ignore",invalid="ignore"):
+    s = (b-a) / np.maximum(a,b)
+  s[(n<2) | ~np.isfinite(s)] = 0
+  return s
+
+# stratified mean of the silhouette of sampled rows and its 95% confidence interval
+def mstratified(rows,s):
+  c = idx[rows]
+  m = np.bincount(c,minlength=CLUSTERS)
+  w = counts/IMAGES
+  mean = np.bincount(c,s,CLUSTERS) / np.maximum(m,1)
+  var = np.bincount(c,(s-mean[c])**2,CLUSTERS) / np.maximum(m-1,1)
+  ci = 1.96 * np.sqrt(np.sum(w**2 * var / np.maximum(m,1) * (1-m/np.maximum(counts,1))))
+  return float(np.sum(w*mean)),float(ci)
+
+# COP from the max. linkage between clusters (max over the rows) and the mean distance
+# from the center of the clustering
+def mcop(rows,maxs):
+  link = np.zeros((CLUSTERS,CLUSTERS),dtype=np.float32)
+  np.maximum.at(link,idx[rows],maxs)
+  link = np.maximum(link,link.T)
+  link[np.arange(CLUSTERS),np.arange(CLUSTERS)] = np.inf
+  link[:,counts==0] = np.inf
+  intra = np.bincount(idx,dist,CLUSTERS) # sums of distances from the center
+  inter = link.min(1)
+  ok = (counts>0) & np.isfinite(inter) & (inter>0)
+  return float(np.sum(intra[ok]/inter[ok]) / IMAGES)
 
-  import validclust
-  pwdist = metrics.pairwise_distances(vectors)
-  COP = validclust.cop(vectors,pwdist,idx)
-  MSG2(f"COP={COP:.3f}")
+# silhouette and COP (exact, or on the sample), return (MSC,ci,COP), ci=0 if exact
+def msilcop():
+  if METRICN and IMAGES > METRICN:
+    rand,far = msample(METRICN)
+    rows = np.concatenate((rand,far))
+    sums,maxs = mreduce(rows)
+    MSC,ci = mstratified(rand,msilhouette(rand,sums[:len(rand)]))
+  else:
+    rows = np.arange(IMAGES)
+    sums,maxs = mreduce(rows)
+    MSC,ci = float(np.mean(msilhouette(rows,sums))),0
+  return MSC,ci,mcop(rows,maxs)
 
-  from s_dbw import S_Dbw
-  SDbw = S_Dbw(vectors,idx,centers_id=None,method='Tong',alg_noise='bind',centr='mean',nearest_centr=True,metric='euclidean')
-  MSG2(f"SDbw={SDbw:.3f}")
+# Calinski-Harabasz and Davies-Bouldin scores (as by sklearn.metrics), in two passes
+# over vectors by batches in float32: cluster centroids, then distances from them
+def mchdb():
+  nz = counts > 0
+  sums = np.zeros((CLUSTERS,vectors.shape[1]),dtype=np.float64)
+  for i in range(0,IMAGES,BATCHSIZE): np.add.at(sums,idx[i:i+BATCHSIZE],np.asarray(vectors[i:i+BATCHSIZE],dtype=np.float32))
+  mean = sums.sum(0) / IMAGES
+  cent = sums[nz] / counts[nz,None]
+  pos = np.cumsum(nz)-1 # cluster -> row of cent
+  W,intra = 0.0,np.zeros(len(cent))
+  for i in range(0,IMAGES,BATCHSIZE):
+    d = np.linalg.norm(np.asarray(vectors[i:i+BATCHSIZE],dtype=np.float32) - cent[pos[idx[i:i+BATCHSIZE]]],axis=1)
+    W += float(np.sum(d**2))
+    intra += np.bincount(pos[idx[i:i+BATCHSIZE]],d,len(cent))
+  k = len(cent)
+  B = float(np.sum(counts[nz] * np.sum((cent-mean)**2,1)))
+  CHS = 1.0 if W == 0 else B*(IMAGES-k) / (W*(k-1))
+  intra /= counts[nz]
+  sq = np.einsum("ij,ij->i",cent,cent)
+  cdist = np.sqrt(np.maximum(sq[:,None] + sq[None,:] - 2*cent@cent.T,0))
+  cdist[np.arange(k),np.arange(k)] = 0
+  if np.allclose(intra,0) or np.allclose(cdist,0): return CHS,0.0
+  cdist[cdist == 0] = np.inf
+  DBS = float(np.mean(np.max((intra[:,None]+intra[None,:]) / cdist,axis=1)))
+  return CHS,DBS
 
-  MSG3("(^= means higher better)")
+# S_Dbw on the sample (or on all images)
+def msdbw():
+  S_Dbw = timport("s_dbw").S_Dbw
+  rows = msample(METRICN)[0] if METRICN and IMAGES > METRICN else slice(None)
+  return S_Dbw(np.asarray(vectors[rows],dtype=np.float32),idx[rows],centers_id=None,method='Tong',alg_noise='bind',centr='mean',nearest_centr=True,metric='euclidean')
+
+# ------------------------------------------------------------------------------------
+
+# all metrics computed in parallel threads (numpy releases the GIL)
+def metric():
+  if args.nometric == 1: return
+  global METRICN
+  if args.msample is not None: METRICN = args.msample
+
+  MSG1("metric"); T1=vtime()
+  from multiprocessing.pool import ThreadPool
+  pool = ThreadPool(4)
+  CHDB = pool.apply_async(mchdb)
+  SILCOP = pool.apply_async(msilcop)
+  SDbw = pool.apply_async(msdbw)
+  pool.close()
+
+  sampled = "~" if METRICN and IMAGES > METRICN else ""
+  CHS,DBS = CHDB.get()
+  MSG2(f"CHS^={CHS:.2f}")
+  MSC,ci,COP = SILCOP.get()
+  MSG2(f"MSC^={MSC:.3f}" + (f"±{ci:.3f}" if sampled else ""))
+  MSG2(f"DBS={DBS:.3f}")
+  MSG2(f"COP{sampled}={COP:.3f}")
+  MSG2(f"SDbw{sampled}={SDbw.get():.3f}")
+  if sampled: MSG2(f"(sample {METRICN})")
+  MSG3(f"in {minsec(vtime()-T1)} (^= means higher better)")
 
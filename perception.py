@@ -1,4 +1,4 @@
-import tensorflow as tf
+tf = None # tensorflow, imported in perception_init only when the model is needed
 
 def  modelname(model): return model._name
 def  inputsize(model): return model._feed_input_shapes[0][1:]
@@ -18,6 +18,27 @@ def modelsize(name):
   if name == "densenet169":	return (224,224,3),(7,7,1664),81536
   if name == "densenet201":	return (224,224,3),(7,7,1920),94080
 
+# spatial pooling of the feature map: grid size of the pooled output (1 for global)
+def poolgrid(pool): return int(pool[1:]) if re.match("g[0-9]+$",pool) else 1
+
+# return output size and vector size after the spatial pooling of osize feature map
+def poolsize(osize,pool):
+  if pool == "none": return osize,osize[0]*osize[1]*osize[2]
+  g = poolgrid(pool)
+  return (g,g,osize[2]),g*g*osize[2]
+
+# add the pooling on top of the model, inside the tf graph
+def poolmodel(model,pool):
+  if pool == "none": return model
+  x = model.output
+  if pool == "avg": x = tf.keras.layers.Lambda(lambda x: tf.reduce_mean(x,axis=[1,2],keepdims=True))(x)
+  if pool == "max": x = tf.keras.layers.Lambda(lambda x: tf.reduce_max(x,axis=[1,2],keepdims=True))(x)
+  if pool == "gem": x = tf.keras.layers.Lambda(lambda x: tf.pow(tf.reduce_mean(tf.pow(tf.maximum(x,1e-6),GEMP),axis=[1,2],keepdims=True),1/GEMP))(x)
+  if poolgrid(pool) > 1:
+    g = poolgrid(pool)
+    x = tf.keras.layers.Lambda(lambda x: tf.image.resize(x,(g,g),method="area"))(x)
+  return tf.keras.Model(model.input,x)
+
 # get sizes from model...
 def realsize(prcpt):
   if prcpt.name == "none": return modelsize(prcpt.name)
@@ -25,14 +46,16 @@ def realsize(prcpt):
   return inputsize(prcpt.model),osize,osize[0]*osize[1]*osize[2]
   
 # load model by name and return "prcpt" structure
-def perception_init(cache,name,isize,osize,vsize):
+def perception_init(cache,name,pool,isize,osize,vsize):
   prcpt = types.SimpleNamespace()
   prcpt.name = name
+  prcpt.pool = pool
 
   if name == "none":
-    prcpt.vsize = vsize
+    prcpt.isize,prcpt.osize,prcpt.vsize = isize,osize,vsize
   else:
     prcpt.isize,prcpt.osize,prcpt.vsize = modelsize(name)
+    prcpt.osize,prcpt.vsize = poolsize(prcpt.osize,pool)
 
   if name == "none": return prcpt	# no model for none model
   if cache.paths0: pass			# needs model for loading
@@ -42,6 +65,8 @@ def perception_init(cache,name,isize,osize,vsize):
   # tensorflow models start here
   MSG1("init perception")
   if not VERBOSE: os.environ['TF_CPP_MIN_LOG_LEVEL'] = '3'
+  global tf
+  tf = timport("tensorflow")
 
   # preproc: from RGB to BGR, each channel zero-centered according ImageNet, no scaling
   if name == "resnet50":
@@ -80,6 +105,8 @@ def perception_init(cache,name,isize,osize,vsize):
     prcpt.model = tf.keras.applications.densenet.DenseNet201(include_top=False,weights="imagenet",input_shape=(224,224,3)) 
     
   prcpt.name = modelname(prcpt.model)
+  if pool != "none": prcpt.name += f"+{pool}"
+  prcpt.model = poolmodel(prcpt.model,pool)
   prcpt.isize,prcpt.osize,prcpt.vsize = realsize(prcpt)
   MSG3(f"{prcpt.name} {lsz(prcpt.isize)} -> {lsz(prcpt.osize)} = {prcpt.vsize}")
   if isize!=prcpt.isize or osize!=prcpt.osize or vsize!=prcpt.vsize:
@@ -89,6 +116,8 @@ def perception_init(cache,name,isize,osize,vsize):
 # ------------------------------------------------------------------------------------
 
 def perceive(prcpt,images):
+  if images.dtype == np.uint8: images = images.astype(np.float32)/255 # 0..1 as from skimage
+  if prcpt.name == "none": return images.reshape(images.shape[0],-1) # raw pixels
   vectors = prcpt.model.predict(prcpt.prepr(images))
   vectors = vectors.reshape(images.shape[0],-1)
   return vectors
@@ -0,0 +1,76 @@
+import threading,queue
+
+# ------------------------------------------------------------------------------------
+# pipeline: batches of images are loaded+resized in a background thread ahead of the
+# perception (bounded by the queue depth), and cache files are written by a background
+# writer, so that decoding, inference and writing overlap
+
+# per-stage accumulated times (background stages overlap with the others)
+def stimes():
+  return {"cache load":0,"image load":0,"perceive":0,"reduce":0,"cache save":0,"wait":0}
+
+# MSG print of stage times
+def MSGstimes(times):
+  s = [f"{k} {minsec(v)}" for k,v in times.items() if v]
+  if s: MSG("stage times",", ".join(s))
+
+# generator of loaded batches (paths,images), loading runs ahead in the thread,
+# malformed images are dropped from the batches and appended into the bad list
+def prefetch(paths,size,times,bad,depth=2):
+  q = queue.Queue(maxsize=depth)
+
+  def producer():
+    try:
+      for i in range(0,len(paths),BATCHSIZE):
+        T = vtime()
+        images,drop = loadresize(paths[i:i+BATCHSIZE],size)
+        times["image load"] += vtime()-T
+        batch = paths[i:i+BATCHSIZE]
+        if drop:
+          bad.extend(drop)
+          drop = set(drop)
+          batch = [p for p in batch if not p in drop]
+        if batch: q.put((batch,images))
+      q.put(None)
+    except BaseException as e: q.put(e)
+
+  threading.Thread(target=producer,daemon=True).start()
+  while True:
+    T = vtime()
+    item = q.get()
+    times["wait"] += vtime()-T
+    if item is None: return
+    if isinstance(item,BaseException): raise item
+    yield item
+
+# start the background cache writer
+def writer_init(cache,times,depth=4):
+  w = types.SimpleNamespace()
+  w.q = queue.Queue(maxsize=depth)
+  w.error = None
+
+  def consumer():
+    while True:
+      item = w.q.get()
+      if item is None: return
+      if w.error: continue	# drain the queue after an error
+      try:
+        T = vtime()
+        csave(cache,*item)
+        times["cache save"] += vtime()-T
+      except BaseException as e: w.error = e
+
+  w.thread = threading.Thread(target=consumer,daemon=True)
+  w.thread.start()
+  return w
+
+# queue the batch of vectors to be written into the cache
+def writer_put(w,paths,sx,vectors):
+  w.q.put((paths,sx,vectors))
+
+# wait for all queued writes to finish
+def writer_end(w):
+  w.q.put(None)
+  w.thread.join()
+  if w.error: raise w.error
+
@@ -0,0 +1,93 @@
+import json,atexit
+
+# ------------------------------------------------------------------------------------
+# profiling: per-stage (and per-batch) records of wall and cpu time, peak RSS, bytes
+# read/written, images per second and stage-specific fields (like cache hits), written
+# at exit as JSONL next to the output (-prof); one stage can run under cProfile
+# (-cprof STAGE, into the .STAGE.pstats file) or tracemalloc (-tmem STAGE)
+
+PROF = []	# finished records
+PROFRUN = {}	# running stages: name -> record
+PROFBATCH = {}	# time of the last batch record of the stage
+PROFON = 0	# whether the records are written
+
+# bytes read and written by the process so far (linux), or (0,0)
+def iobytes():
+  try:
+    with open("/proc/self/io") as fd: io = dict(line.split(": ") for line in fd.read().splitlines())
+    return int(io["rchar"]),int(io["wchar"])
+  except (OSError,KeyError,ValueError): return 0,0
+
+# cpu time of the process and its finished children
+def cputime():
+  s = resource.getrusage(resource.RUSAGE_SELF)
+  c = resource.getrusage(resource.RUSAGE_CHILDREN)
+  return s.ru_utime + s.ru_stime + c.ru_utime + c.ru_stime
+
+# enable the profiling, the report is written at exit
+def prof_init():
+  global PROFON
+  PROFON = args.prof or args.cprof or args.tmem
+  if PROFON: atexit.register(prof_write)
+
+# start the stage
+def prof_start(name):
+  if not PROFON: return
+  r = {"stage":name,"start":round(vtime()-T00,4)}
+  r["_wall"],r["_cpu"],r["_io"] = vtime(),cputime(),iobytes()
+  if args.cprof == name:
+    import cProfile
+    r["_cprof"] = cProfile.Profile()
+    r["_cprof"].enable()
+  if args.tmem == name:
+    import tracemalloc
+    tracemalloc.start()
+  PROFRUN[name] = r
+  PROFBATCH[name] = vtime()
+
+# add fields to the running stage
+def prof_note(name,**fields):
+  if name in PROFRUN: PROFRUN[name].update(fields)
+
+# finish the stage, with its fields (images = no. of processed images)
+def prof_stop(name,**fields):
+  if not name in PROFRUN: return
+  r = PROFRUN.pop(name)
+  r.update(fields)
+  wall = vtime()-r.pop("_wall")
+  io0,io = r.pop("_io"),iobytes()
+  r["wall"] = round(wall,4)
+  r["cpu"] = round(cputime()-r.pop("_cpu"),4)
+  r["rss"] = peakram()
+  r["read"],r["written"] = io[0]-io0[0],io[1]-io0[1]
+  if r.get("images") and wall > 0: r["ips"] = round(r["images"]/wall,1)
+
+  if "_cprof" in r:
+    pr = r.pop("_cprof")
+    pr.disable()
+    r["pstats"] = f"{outputname()}.{name}.pstats"
+    pr.dump_stats(r["pstats"])
+  if args.tmem == name:
+    import tracemalloc
+    top = tracemalloc.take_snapshot().statistics("lineno")[:10]
+    r["tmem peak"] = tracemalloc.get_traced_memory()[1]
+    r["tmem top"] = [f"{t.traceback} {t.size}" for t in top]
+    tracemalloc.stop()
+  PROF.append(r)
+
+# record a batch of the stage: its images and time since the previous batch
+def prof_batch(name,j,images,kind=""):
+  if not name in PROFRUN: return
+  T = vtime()
+  PROF.append({"stage":name,"batch":j,"kind":kind,"images":images,"wall":round(T-PROFBATCH[name],4)})
+  PROFBATCH[name] = T
+
+# write the report (at exit)
+def prof_write():
+  if not PROF: return
+  file = f"{outputname()}.prof.jsonl"
+  with open(file,"w") as fd:
+    fd.write(json.dumps({"run":" ".join(sys.argv),"threads":THREADS,"batchsize":BATCHSIZE,"wall":round(vtime()-T00,4),"cpu":round(cputime(),4),"rss":peakram()})+"\n")
+    for r in PROF: fd.write(json.dumps(r,default=float)+"\n")
+  MSG("profile",file)
+
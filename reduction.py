@@ -1,5 +1,67 @@
 # include "loading.py"
-from sklearn.decomposition import PCA
+import pickle,hashlib,glob
+
+# ------------------------------------------------------------------------------------
+# trained reducer is saved along the cache, keyed by the model, size and the digest of
+# its training set: the digest is a part of the reduced-vectors suffix, so that all
+# cached reduced vectors of a suffix come from the same reducer; the reducer file is
+# the header (digest, no. of samples, keys of the training set) and the model, a later
+# run uses the newest reducer trained on a subset of its images (added images are only
+# transformed), reducers trained on other images are never reused
+
+def redim_file(cache): return f"{args.storedir}/{cache.sx2}.redim"
+
+# digest of the set of images
+def redim_digest(keys): return hashlib.blake2b("\n".join(sorted(keys)).encode(),digest_size=16).hexdigest()
+
+# attach the reducer to the cache: the suffix of reduced vectors by the digest of the
+# reducer of the model to assign to, or of the newest stored reducer trained on a subset
+# of paths (cache.rdigest None if there is none yet)
+def redim_attach(cache,paths):
+  cache.rdigest = None
+  sx = cache.sx2
+  if AMODEL:
+    if AMODEL.get("rdigest") and AMODEL["sx2"] == f"{sx}-{AMODEL['rdigest'][:8]}":
+      cache.sx2,cache.rdigest = AMODEL["sx2"],AMODEL["rdigest"]
+    return
+  files = glob.glob(f"{glob.escape(args.storedir)}/{glob.escape(sx)}-*.redim")
+  if not files: return
+  have = {ckey(cache,p) for p in paths}
+  for file in sorted(files,key=os.path.getmtime,reverse=True):
+    with open(file,"rb") as fd: head = pickle.load(fd)
+    if head["keys"] <= have:
+      cache.sx2,cache.rdigest = f"{sx}-{head['digest'][:8]}",head["digest"]
+      return
+
+# load the trained reducer of the cache (or from the file), return 1 if available
+def redim_load(cache,redim,file=None):
+  if file is None:
+    if not cache.rdigest: return 0
+    file = redim_file(cache)
+  if not os.path.exists(file): return 0
+  with open(file,"rb") as fd:
+    head = pickle.load(fd)
+    redim.model = pickle.load(fd)
+  if head["digest"] != cache.rdigest: MSGE(f"reducer {file} is not the one of {cache.sx2} vectors")
+  redim.size = int(redim.model.n_components_)
+  MSG(f"{redim.name} load",f"trained on {head['pats']} samples (set {head['digest'][:8]}) from {file}")
+  return 1
+
+# save the trained reducer, the digest of the training set goes into the suffix of
+# reduced vectors (and their store is opened)
+def redim_save(cache,redim,paths):
+  keys = {ckey(cache,p) for p in paths}
+  cache.rdigest = redim_digest(keys)
+  cache.sx2 = f"{cache.sx2}-{cache.rdigest[:8]}"
+  if args.store: cache.stores[cache.sx2] = store_open(args.storedir,qsx(cache,cache.sx2),cache.quant)
+  if not args.cache: return
+  if not os.path.isdir(args.storedir): os.makedirs(args.storedir)
+  with open(f"{redim_file(cache)}.tmp","wb") as fd:
+    pickle.dump({"digest":cache.rdigest,"pats":len(paths),"keys":keys},fd)
+    pickle.dump(redim.model,fd)
+  os.replace(f"{redim_file(cache)}.tmp",redim_file(cache))
+
+# ------------------------------------------------------------------------------------
 
 def reduction_init(cache,prcpt,REDIM,REDIMSIZE,REDIMPATS):
   redim = types.SimpleNamespace()
@@ -15,68 +77,129 @@ def reduction_init(cache,prcpt,REDIM,REDIMSIZE,REDIMPATS):
     redim.pats = 0
   
   # redim not needed
-  if cache.paths2 and not cache.paths1 and not cache.paths0: return redim
   if redim.name == "none": return redim
 
+  # trained by the journaled run
+  redim.model = journal_get("reducer")
+  if redim.model is not None:
+    redim.size = int(redim.model.n_components_)
+    MSG(f"{redim.name} load","from the journal")
+    return redim
+
+  # reducer of the clustering to assign new images to: stored along the cache, or in
+  # the model itself
+  if AMODEL:
+    redim.model = AMODEL["reducer"]
+    file = AMODEL.get("redimfile") or redim_file(cache)
+    if redim.model is None and not redim_load(cache,redim,file): MSGE(f"no reducer {file} of the model")
+    redim.size = int(redim.model.n_components_)
+    return redim
+
+  # all vectors are reduced already, the reducer is loaded for the model only
+  if not cache.paths1 and not cache.paths0:
+    redim_load(cache,redim)
+    return redim
+
+  # already trained
+  if redim_load(cache,redim): return redim
+
   # trainable modes
   MSG(f"{redim.name} setup",f"{prcpt.vsize} -> {redim.size} dimensions (from {redim.pats} samples)")
 
   # engine init
-  redim.model = PCA(n_components=redim.size)
+  decomposition = timport("sklearn.decomposition")
+  PCA,IncrementalPCA = decomposition.PCA,decomposition.IncrementalPCA
+  if redim.name == "pca":  redim.model = PCA(n_components=redim.size,random_state=args.seed)
+  if redim.name == "rpca": redim.model = PCA(n_components=redim.size,svd_solver="randomized",random_state=args.seed)
+  if redim.name == "ipca": redim.model = IncrementalPCA(n_components=redim.size)
   # redim.model = cuml.PCA(n_components=redim.size)
 
   # loading
   MSG1(f"{redim.name} train"); T1 = vtime()
   j = 0 # batch index
-  all_vectors = np.empty([0,prcpt.vsize],dtype=np.float32)
+  k = 0 # output row index
+  end1 = min(len(cache.paths1all),redim.pats)
+  end2 = min(len(cache.paths0all),redim.pats)
+  trained = cache.paths1all[:end1] + cache.paths0all[:end2] # training set
+
+  # incremental mode is trained in chunks of at least redim.size vectors, when the
+  # buffer is full, other modes on all vectors at once
+  incr = redim.name == "ipca"
+  all_vectors = valloc(min(BATCHSIZE+redim.size,end1+end2) if incr else end1+end2,prcpt.vsize)
+  mem = 0	# accumulated size of training vectors
+  tfit = 0	# incremental training time
+  def train(vectors):
+    nonlocal k,mem,tfit
+    if incr and k+len(vectors) > len(all_vectors):
+      T = vtime()
+      redim.model.partial_fit(all_vectors[:k])
+      tfit += vtime()-T
+      k = 0
+    all_vectors[k:k+len(vectors)] = vectors
+    k += len(vectors)
+    mem += vectors.nbytes
 
   # 1st: load cached vectors
   i = 0 # image index
-  end = min(len(cache.paths1all),redim.pats)
+  end = end1
   while i < end:
     i2 = i + BATCHSIZE
     if i2 > end: i2 = end
     MSGC("c")
-    vectors = loadraws(cache.paths1all[i:i2],cache.sx1s,cache.cdir)
+    vectors = cload(cache,cache.paths1all[i:i2],cache.sx1s)
     MSGP(j)
-    all_vectors = np.concatenate((all_vectors,vectors),0)
+    train(vectors)
     i += len(vectors)
     j += 1
   
-  # 2nd: load raw images
-  i = 0
-  end = min(len(cache.paths0all),redim.pats)
-  while i < end:
-    i2 = i + BATCHSIZE
-    if i2 > end: i2 = end
-    MSGC("l")
-    images = loadresize(cache.paths0all[i:i2],prcpt.isize)
-    MSGC("\bn")
+  # 2nd: load raw images (loading runs ahead, cache is written in background)
+  times = stimes()
+  writer = writer_init(cache,times)
+  bad = [] # malformed images
+  for batch,images in prefetch(cache.paths0all[:end2],prcpt.isize,times,bad):
+    MSGC("n"); T = vtime()
     vectors = perceive(prcpt,images)
+    times["perceive"] += vtime()-T
     if args.cache:
-      saveraws(cache.paths0all[i:i2],cache.sx1,cache.cdir,vectors)
-      cached += cache.paths0all[i:i2]
+      writer_put(writer,batch,cache.sx1,vectors)
+      cached += batch
     MSGP(j)
-    all_vectors = np.concatenate((all_vectors,vectors),0)
-    i += len(vectors)
+    train(vectors)
     j += 1
-
-  # 3rd: train redim
-  mem = all_vectors.nbytes
+  writer_end(writer)
+  if bad:
+    cache_drop(cache,bad)
+    skip = set(bad)
+    trained = [p for p in trained if not p in skip]
+
+  # less dimensions than planned, when dropped images left fewer samples
+  size = redim.size
+  if len(trained) < redim.size:
+    redim.size = max(1,len(trained))
+    redim.model.set_params(n_components=redim.size)
+
+  # 3rd: train redim (the rest of it in incremental mode)
   MSGC("R"); T2 = vtime()
-  redim.model.fit(all_vectors)
+  if not incr: redim.model.fit(all_vectors[:k])
+  elif k >= redim.size or not hasattr(redim.model,"components_"): redim.model.partial_fit(all_vectors[:k])
+  redim_save(cache,redim,trained)
+  journal_put("reducer",redim.model)
 
   # end
   MSGP(j); T3 = vtime()
   MSG2(f" {metric(mem)}B of vectors,")
-  MSG2(f"{minsec(T2-T1)} loading,")
-  MSG2(f"{minsec(T3-T2)} training time")
-  MSG3("")
+  MSG2(f"{minsec(T2-T1-tfit)} loading,")
+  MSG2(f"{minsec(T3-T2+tfit)} training time,")
+  MSG3(f"{metric(peakram())}B peak RAM")
+  MSGstimes(times)
+  MSGbad(bad)
+  if redim.size < size: MSG(f"{redim.name} size",f"{redim.size} dimensions instead of {size}, as trained on {len(trained)} samples")
 
   # move newly cached vectors from paths0 to paths1
   if args.cache and cached:
-    cache.paths0 = list(set(cache.paths0).difference(set(cached)))	# paths0 = paths0 - cached
-    cache.paths1 = list(set(cache.paths1 + cached))			# paths1 = paths1 + cached
+    done,have = set(cached),set(cache.paths1)			# sets for membership only, lists keep the order
+    cache.paths0 = [p for p in cache.paths0 if not p in done]	# paths0 = paths0 - cached
+    cache.paths1 += [p for p in cached if not p in have]	# paths1 = paths1 + cached
     MSG1("newly cached")
     MSG2(f"{len(cached)} pepcept. vectors, so we got")
     MSG2cached(cache)
@@ -0,0 +1,145 @@
+from multiprocessing.pool import ThreadPool
+
+# ------------------------------------------------------------------------------------
+# scan of input paths: directories are walked by os.scandir in a single pass for all
+# image suffixes, subdirectories of every input dir in parallel threads (hidden files
+# and dirs skipped, as by glob); csv files are parsed in-process, and existence of the
+# listed (or explicit) files is checked in batches, by listing their directories;
+# with -sm the walk is remembered in the manifest file, and directories unchanged
+# since (by their mtime) are not listed again
+
+SCANEXTS = (".jpg",".png") # image suffixes
+SCANLIST = 16 # min. no. of checked files in a dir to list it instead of stat of each
+
+# load the manifest: dir -> (mtime,names), names of subdirs end with "/"
+def manifest_load(file):
+  old = {}
+  if not file or not os.path.exists(file): return old
+  with open(file) as fd:
+    for line in fd:
+      line = line.rstrip("\n")
+      if line[:2] == "d ":
+        mtime,dir = line[2:].split(" ",1)
+        names = []
+        old[dir] = (int(mtime),names)
+      elif line: names.append(line)
+  return old
+
+# save the manifest: "d mtime dir" line per directory, followed by its names
+def manifest_save(file,dirs):
+  with open(f"{file}.tmp","w") as fd:
+    for dir,(mtime,names) in dirs.items():
+      fd.write(f"d {mtime} {dir}\n")
+      fd.writelines(f"{name}\n" for name in names)
+  os.replace(f"{file}.tmp",file)
+
+# list the dir: (mtime,names) of image files and subdirs, from the manifest if unchanged,
+# the 3rd returned value is whether it was listed
+def scan_list(dir,old):
+  try: mtime = os.stat(dir).st_mtime_ns
+  except OSError: return None,None,0
+  if dir in old and old[dir][0] == mtime: return mtime,old[dir][1],0
+  names = []
+  try:
+    with os.scandir(dir) as it:
+      for e in it:
+        if e.name[0] == ".": continue
+        if e.name.endswith(SCANEXTS): names.append(e.name)
+        elif e.is_dir(): names.append(e.name+"/")
+  except OSError: return None,None,0
+  return mtime,names,1
+
+# walk the tree under the dir, return image files, visited dirs, and no. of listed dirs
+def scan_walk(top,exts,old):
+  files,dirs,listed = [],{},0
+  stack = [top]
+  while stack:
+    dir = stack.pop()
+    mtime,names,new = scan_list(dir,old)
+    if mtime is None: continue
+    dirs[dir] = (mtime,names)
+    listed += new
+    for name in names:
+      if name[-1] == "/": stack.append(os.path.join(dir,name[:-1]))
+      elif name.endswith(exts): files.append(os.path.join(dir,name))
+  return files,dirs,listed
+
+# walk the input dir: its top level first, then subdirs in parallel
+def scan_tree(top,exts,old,pool):
+  mtime,names,listed = scan_list(top,old)
+  if mtime is None: return [],{},0
+  dirs = {top:(mtime,names)}
+  files = [os.path.join(top,n) for n in names if n[-1] != "/" and n.endswith(exts)]
+  subs = [os.path.join(top,n[:-1]) for n in names if n[-1] == "/"]
+  for f,d,l in pool.imap_unordered(lambda dir: scan_walk(dir,exts,old),subs):
+    files += f
+    dirs.update(d)
+    listed += l
+  return files,dirs,listed
+
+# existing files of the list: file -> size (if sizes, else 1), checked by directories,
+# small groups by stat of each file, bigger by a single listing of the dir
+def scan_exist(files,pool,sizes=0):
+  bydir = {}
+  for file in files: bydir.setdefault(os.path.dirname(file),[]).append(file)
+  def stat(file):
+    try: st = os.stat(file)
+    except OSError: return None
+    return st.st_size if sizes else 1
+  def worker(dir):
+    group = bydir[dir]
+    if len(group) < SCANLIST: return [(f,stat(f)) for f in group]
+    want = {os.path.basename(f) for f in group}
+    try:
+      with os.scandir(dir or ".") as it: names = {e.name:e for e in it if e.name in want}
+    except OSError: return []
+    found = []
+    for f in group:
+      e = names.get(os.path.basename(f))
+      if e is None: continue
+      try: found.append((f,e.stat().st_size if sizes else 1))
+      except OSError: pass	# broken link
+    return found
+  ok = {}
+  for found in pool.imap_unordered(worker,bydir): ok.update((f,s) for f,s in found if s is not None)
+  return ok
+
+# first column of the csv file, without comments
+def scan_csv(file):
+  files = []
+  with open(file) as fd:
+    for line in fd:
+      name = line.rstrip("\n").split(" ",1)[0]
+      if name and name[0] != "#": files.append(name)
+  return files
+
+# scan requested paths: return found image paths (sorted, unique), wrong paths, and
+# the numbers of listed/all dirs
+def scan_paths(names,manifest=None):
+  exts = (".jpg",) if args.jpgonly else SCANEXTS
+  old = manifest_load(manifest)
+  pool = ThreadPool(THREADS)
+  paths,check,poor = [],[],[]
+  dirs,listed = {},0
+  for name in names:
+    if   re.search("\.csv$",name): check += scan_csv(name)	# 1st: from CSV (use the 1st column)
+    elif re.search("\.jpg$",name): check.append(name)		# 2nd: explicit jpg filenames
+    elif not args.jpgonly and re.search("\.png$",name): check.append(name)	# 3rd: png
+    elif os.path.isdir(name):						# 4th: directory
+      f,d,l = scan_tree(name,exts,old,pool)
+      paths += f
+      dirs.update(d)
+      listed += l
+    else: poor.append(name)
+
+  ok = scan_exist(check,pool)
+  pool.close()
+  paths += [f for f in check if f in ok]
+  poor += [f for f in check if not f in ok]
+
+  walked = len(dirs)
+  if manifest and dirs and (listed or not os.path.exists(manifest)):
+    for dir in old:
+      if not dir in dirs: dirs[dir] = old[dir]	# other trees of the manifest
+    manifest_save(manifest,dirs)
+  return sorted(set(paths)),poor,listed,walked
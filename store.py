@@ -0,0 +1,85 @@
+# ------------------------------------------------------------------------------------
+# vector store: one append-only raw matrix file per suffix in the cache dir, plus the
+# index file with a key (image path or content key) per line, line order = row; rows
+# are float32 vectors, or encoded (f16, or i8 with the scale) as the per-image files
+
+# open the store for the suffix sx in the dir cdir (empty store if files don't exist)
+def store_open(cdir,sx,enc="f32"):
+  st = types.SimpleNamespace()
+  st.data  = f"{cdir}/{sx}.raw"	# matrix file
+  st.index = f"{cdir}/{sx}.idx"	# index file
+  st.enc   = enc			# encoding of rows
+  st.dim   = 0			# vector size, known after the first write
+  st.keys  = []			# row -> key
+  st.rows  = {}			# key -> row
+  st.n     = 0			# number of rows
+  st.mm    = None		# memory-map of the matrix, reopened after writes
+  st.dirty = 0			# index has more lines than the matrix rows
+  if not os.path.exists(st.index): return st
+
+  with open(st.index) as fd:
+    for line in fd:
+      line = line.rstrip("\n")
+      if   line[:5] == "#dim ": st.dim = int(line[5:])
+      elif line[:5] == "#enc ":
+        if line[5:] != enc: MSGE(f"store {st.data} encoded in {line[5:]}, expected {enc}")
+      else: st.keys.append(line)
+
+  # only rows fully written to both files are valid (after an interrupted write)
+  if st.dim and os.path.exists(st.data):
+    st.n = min(len(st.keys),os.path.getsize(st.data)//store_rowsize(st))
+  st.dirty = len(st.keys) > st.n
+  del st.keys[st.n:]
+  for i in range(st.n): st.rows[st.keys[i]] = i	# later duplicates override earlier
+  return st
+
+# items (of the file dtype) and bytes per row
+def store_width(st): return st.dim+4 if st.enc == "i8" else st.dim
+def store_rowsize(st): return store_width(st) * np.dtype(QDTYPES[st.enc]).itemsize
+
+# the index header
+def store_header(st):
+  return f"#dim {st.dim}\n" + (f"#enc {st.enc}\n" if st.enc != "f32" else "")
+
+# whether the image is in the store
+def store_has(st,key): return key in st.rows
+
+# get vectors of images from the memory-map: rows are read in the ascending order (so
+# the read is sequential for shuffled images too) and put back in the order of keys,
+# contiguous ascending rows are a zero-copy slice; encoded rows are decoded in batch
+def store_get(st,keys):
+  if st.mm is None or len(st.mm) != st.n:
+    st.mm = np.memmap(st.data,dtype=QDTYPES[st.enc],mode="r",shape=(st.n,store_width(st)))
+  rows = np.array([st.rows[k] for k in keys],dtype=np.int64)
+  if len(rows) and rows[-1]-rows[0] == len(rows)-1 and np.all(np.diff(rows) == 1):
+    return qdecode(st.mm[rows[0]:rows[-1]+1],st.enc)
+  o = np.argsort(rows,kind="stable")
+  vectors = qdecode(st.mm[rows[o]],st.enc)
+  out = np.empty_like(vectors)
+  out[o] = vectors
+  return out
+
+# append vectors of images to the store, matrix first, then the index
+def store_put(st,keys,vectors):
+  arr = np.asarray(vectors,dtype=np.float32)
+  if not st.dim:
+    st.dim = arr.shape[1]
+    with open(st.index,"w") as fd: fd.write(store_header(st))
+  if arr.shape[1] != st.dim: MSGE(f"store {st.data} vector size {arr.shape[1]}, expected {st.dim}")
+
+  # truncate the tail of an interrupted write, to keep rows aligned with the index
+  if st.dirty or os.path.exists(st.data) and os.path.getsize(st.data) != store_rowsize(st)*st.n:
+    if os.path.exists(st.data): os.truncate(st.data,store_rowsize(st)*st.n)
+    with open(st.index,"w") as fd:
+      fd.write(store_header(st))
+      for key in st.keys: fd.write(f"{key}\n")
+    st.dirty = 0
+
+  with open(st.data,"ab") as fd: qencode(arr,st.enc).tofile(fd)
+  with open(st.index,"a") as fd:
+    for key in keys:
+      st.keys.append(key)
+      st.rows[key] = st.n
+      st.n += 1
+      fd.write(f"{key}\n")
+
@@ -0,0 +1,65 @@
+# ------------------------------------------------------------------------------------
+# sweep of the number of clusters: vectors are loaded once, K values are fitted in
+# parallel processes (sharing the sample by fork) on at most SWEEPN images, scored by
+# cheap metrics, and the best K by silhouette is returned with its centers to start
+# the final clustering of all images from
+
+SWEEPN = 20000 # max. images to fit the sweep on
+SWEEPX = None # the sample of vectors
+
+# parse "from:to:step" (step dflt. for 8 values) or "k1,k2,..." into the list of K
+def sweep_parse(s):
+  try:
+    if ":" in s:
+      a = [int(x) for x in s.split(":")]
+      step = a[2] if len(a) > 2 else max(1,(a[1]-a[0])//8)
+      return list(range(a[0],a[1]+1,step))
+    return [int(x) for x in s.split(",")]
+  except (ValueError,IndexError): MSGE(f"wrong clusters sweep {s}")
+
+# fit and score a single K (worker), BLAS/OpenMP single-threaded as workers are parallel
+def sweep_fit(k,threads=1):
+  from threadpoolctl import threadpool_limits
+  metrics = timport("sklearn.metrics")
+  r = types.SimpleNamespace(k=k,CHS=0,MSC=-1,DBS=0)
+  with threadpool_limits(threads):
+    T = vtime()
+    clust,_ = clust_engine(k)
+    clust.verbose = 0
+    clust.fit(SWEEPX)
+    r.time = vtime()-T
+    r.inertia = clust.inertia_
+    r.centers = clust.cluster_centers_
+    labels = clust.labels_
+    if len(np.unique(labels)) > 1:
+      r.CHS = metrics.calinski_harabasz_score(SWEEPX,labels)
+      r.DBS = metrics.davies_bouldin_score(SWEEPX,labels)
+      r.MSC = metrics.silhouette_score(SWEEPX,labels,sample_size=min(len(SWEEPX),4000),random_state=args.seed)
+  return r
+
+# sweep over the list of K, write the scores, return the best K and its centers
+def sweep(ks):
+  global SWEEPX
+  MSG1("clusters sweep"); T1 = vtime()
+  rows = slice(None)
+  if IMAGES > SWEEPN: rows = np.sort(np.random.default_rng(args.seed).choice(IMAGES,SWEEPN,replace=False))
+  SWEEPX = np.asarray(vectors[rows],dtype=np.float32)
+  MSG2(f"{len(ks)} values {ks[0]}..{ks[-1]} on {len(SWEEPX)} images")
+
+  # bigger K first, as they take longer
+  procs = min(THREADS,len(ks))
+  results = journal_map("sweep",sweep_fit,[(k,1 if procs > 1 else None) for k in ks[::-1]],procs)
+  results.sort(key=lambda r: r.k)
+  best = max(results,key=lambda r: r.MSC)
+  MSG3(f"in {minsec(vtime()-T1)}")
+
+  # scores curve
+  output = f"{outputname(f'{ks[0]}-{ks[-1]}')}.sweep.csv"
+  with open(output,"w") as fd:
+    fd.write("#clusters inertia CHS MSC DBS time\n")
+    for r in results: fd.write(f"{r.k} {r.inertia:.2f} {r.CHS:.2f} {r.MSC:.3f} {r.DBS:.3f} {r.time:.2f}\n")
+  MSG1("best clusters")
+  MSG3(f"{best.k} MSC^={best.MSC:.3f} (scores in {output})")
+  SWEEPX = None
+  return best.k,best.centers
+
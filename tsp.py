@@ -0,0 +1,151 @@
+import math
+
+# ------------------------------------------------------------------------------------
+# ordering of points by TSP: nearest-neighbour tour improved by 2-opt and Or-opt moves,
+# both restricted to the kNN candidate graph and limited by the time budget
+
+# return k nearest neighbours of every point (and their distances), sorted by distance
+def tsp_knn(P,k):
+  n = len(P)
+  k = min(k,n-1)
+  sq = np.einsum("ij,ij->i",P,P)
+  P64 = np.float64(P)
+  nn = np.empty((n,k),dtype=np.int64)
+  nd = np.empty((n,k),dtype=np.float64)
+  for i in range(0,n,1024):
+    d = sq[i:i+1024,None] + sq[None,:] - 2*P[i:i+1024]@P.T
+    d[np.arange(len(d)),np.arange(i,i+len(d))] = np.inf	# not itself
+    j = np.argpartition(d,k-1,axis=1)[:,:k]
+    dj = np.linalg.norm(P64[j]-P64[i:i+1024,None],axis=2) # exact, the above cancels out for close points
+    o = np.argsort(dj,1)
+    nn[i:i+1024] = np.take_along_axis(j,o,1)
+    nd[i:i+1024] = np.take_along_axis(dj,o,1)
+  return nn,nd
+
+# nearest-neighbour tour from the start point, through candidates when possible
+def tsp_nearest(P,nn,start):
+  n = len(P)
+  sq = np.einsum("ij,ij->i",P,P)
+  visited = np.zeros(n,dtype=bool)
+  tour = np.empty(n,dtype=np.int64)
+  nn = nn.tolist()
+  a = start
+  for i in range(n):
+    tour[i] = a
+    visited[a] = True
+    if i == n-1: break
+    nxt = -1
+    for c in nn[a]:
+      if not visited[c]:
+        nxt = c
+        break
+    if nxt < 0: # all candidates visited: the nearest of all unvisited
+      d = sq - 2*(P@P[a])
+      d[visited] = np.inf
+      nxt = int(np.argmin(d))
+    a = nxt
+  return tour
+
+# length of the closed tour
+def tsp_length(P,tour):
+  return float(np.linalg.norm(P[tour]-P[np.roll(tour,-1)],axis=1).sum())
+
+# improve the closed tour in place by 2-opt and Or-opt moves, till the deadline T1;
+# distances are float64 as the nd of tsp_knn, and the gains below the tolerance (relative
+# to the tour length) are rounding only, e.g. of duplicate points
+def tsp_improve(P,tour,nn,nd,T1):
+  n = len(tour)
+  if n < 5: return tour
+  pos = np.empty(n,dtype=np.int64)
+  pos[tour] = np.arange(n)
+  nn,nd = nn.tolist(),nd.tolist()
+  P64 = np.float64(P)
+  def d(a,b):
+    v = P64[a]-P64[b]
+    return math.sqrt(float(np.dot(v,v)))
+  eps = 1e-9 * tsp_length(P64,tour)
+
+  improved = 1
+  while improved and vtime() < T1:
+    improved = 0
+
+    # 2-opt: edges a-b and c-d replaced by a-c and b-d, with c a candidate of a
+    for a in range(n):
+      if vtime() > T1: break
+      i = pos[a]
+      b = tour[(i+1)%n]
+      dab = d(a,b)
+      for c,dac in zip(nn[a],nd[a]):
+        if dac >= dab: break
+        j = pos[c]
+        e = tour[(j+1)%n]
+        if c == b or e == a: continue
+        if dab + d(c,e) - dac - d(b,e) > eps:
+          s,t = (i+1,j) if i < j else (j+1,i)	# reverse b..c, or the complement e..a
+          tour[s:t+1] = tour[s:t+1][::-1].copy()
+          pos[tour[s:t+1]] = np.arange(s,t+1)
+          improved = 1
+          break
+
+    # Or-opt: segment of 1-3 points starting at a moved next to its candidate c
+    for L in (1,2,3):
+      for a in range(n):
+        if vtime() > T1: break
+        i = pos[a]
+        seg = tour[np.arange(i,i+L)%n]
+        z = seg[-1]
+        p = tour[(i-1)%n]
+        x = tour[(i+L)%n]
+        if p in seg or x in seg: continue
+        gain = d(p,a) + d(z,x) - d(p,x)	# gain of the removal
+        for c,dac in zip(nn[a],nd[a]):
+          if dac >= gain: break
+          if c in seg: continue
+          j = pos[c]
+          cn = tour[(j+1)%n]	# c,a..z,cn
+          cp = tour[(j-1)%n]	# cp,z..a,c
+          best,fwd = 0,1
+          if not cn in seg:
+            g = gain - (dac + d(z,cn) - d(c,cn))
+            if g > best: best,fwd = g,1
+          if not cp in seg:
+            g = gain - (dac + d(z,cp) - d(cp,c))
+            if g > best: best,fwd = g,0
+          if best > eps:
+            rest = np.delete(tour,np.arange(i,i+L)%n)
+            k = int(np.flatnonzero(rest == c)[0])
+            if fwd: new = np.concatenate((rest[:k+1],seg,rest[k+1:]))
+            else:   new = np.concatenate((rest[:k],seg[::-1],rest[k:]))
+            tour[:] = new
+            pos[tour] = np.arange(n)
+            improved = 1
+            break
+
+  return tour
+
+# return the order of points as an open path (cut at the longest edge of the tour, or
+# starting at the start point) and its length, seed is for the random first point
+def tsp_order(P,budget,seed=None,start=None,k=8):
+  n = len(P)
+  if n < 3:
+    path = [1,0] if start == 1 else list(range(n))
+    return path,float(np.linalg.norm(P[0]-P[-1])) if n else 0.0
+  T1 = vtime() + budget
+  P = np.ascontiguousarray(P,dtype=np.float32)
+  nn,nd = tsp_knn(P,k)
+  first = start if start is not None else int(np.random.default_rng(seed).integers(n))
+  tour = tsp_nearest(P,nn,first)
+  tour = tsp_improve(P,tour,nn,nd,T1)
+
+  # open the tour: edge i is tour[i] -> tour[i+1]
+  edges = np.linalg.norm(P[tour]-P[np.roll(tour,-1)],axis=1)
+  if start is None:
+    cut = int(np.argmax(edges))
+    path = np.roll(tour,-(cut+1))
+  else:
+    i = int(np.flatnonzero(tour == start)[0])
+    if edges[i-1] >= edges[i]: path = np.roll(tour,-i)	# drop the edge before start
+    else: path = np.roll(tour[::-1],-(n-1-i))		# drop the edge after start
+  length = float(edges.sum() - np.linalg.norm(P[path[-1]]-P[path[0]]))
+  return list(path),length
+
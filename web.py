@@ -50,6 +50,25 @@ HTML="""<!DOCTYPE html>
 </html>
 """
 
+# html page head and tail, to stream the body in between
+HTMLHEAD,HTMLTAIL = HTML.split("{BODY}")
+HTMLHEAD = HTMLHEAD.format(CSS=CSS)
+
+# return the file name of html page, 1st page is just base.html
+def htmlpage(base,page):
+  if page == 0: return f"{base}.html"
+  return f"{base}.{page+1}.html"
+
+# return navigation links between html pages
+def htmlnav(base,page,pages):
+  if pages < 2: return ""
+  s = "<h2>"
+  for p in range(pages):
+    if p == page: s += f" {p+1}"
+    else: s += f' <a href="{os.path.basename(htmlpage(base,p))}">{p+1}</a>'
+  s += "</h2>\n"
+  return s
+
 def addimg(path,clas,title,bad):
   b = " bad" if bad else ""
   s = ""